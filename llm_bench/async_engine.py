@@ -0,0 +1,256 @@
+"""
+Asyncio engine for load_test.py, enabled with `--engine asyncio`.
+
+Instead of spawning one Locust user (a greenlet with its own requests session and connection
+pool) per `-u` user, a single Locust user runs an asyncio event loop with one task per user
+sharing an aiohttp session. Streams are much cheaper this way, so one process can keep tens of
+thousands of them open. Request sampling, response parsing and metrics are shared with LLMUser,
+so the summary and the CSV files are the same as with the default engine.
+"""
+import asyncio
+import random
+import time
+
+import aiohttp
+
+from load_test import (
+    ClientMonitor,
+    FixedQPSPacer,
+    InitTracker,
+    LLMUser,
+    report_request_phases,
+)
+
+
+def timed_trace_config():
+    """
+    Records the phases of every request like TimedConnectionMixin does, into the dict passed as
+    `trace_request_ctx`. aiohttp opens the TCP connection and does the TLS handshake in one step,
+    so `tcp_end` includes the latter and `connect_tls` isn't reported.
+    """
+
+    def record(name):
+        async def callback(session, context, params):
+            context.trace_request_ctx[name] = time.perf_counter()
+
+        return callback
+
+    async def on_connection_create_end(session, context, params):
+        phases = context.trace_request_ctx
+        # no resolution for IP addresses and cached hosts
+        phases.setdefault("dns_end", phases["connect_start"])
+        phases["tcp_end"] = phases["connect_end"] = time.perf_counter()
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_create_start.append(record("connect_start"))
+    trace_config.on_dns_resolvehost_end.append(record("dns_end"))
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_request_headers_sent.append(record("request_start"))
+    # the body is sent in one or more chunks, the last one ends the upload
+    trace_config.on_request_chunk_sent.append(record("request_sent"))
+    trace_config.on_request_end.append(record("headers_received"))
+    return trace_config
+
+
+class AsyncLLMUser(LLMUser):
+    def _init_pacing(self):
+        options = self.environment.parsed_options
+        if options.trace or options.conversation_turns:
+            raise ValueError(
+                "--trace and --conversation-turns are not supported with --engine asyncio"
+            )
+        if options.qps is not None and options.burst:
+            raise ValueError("Burst and QPS modes are mutually exclusive")
+        if options.open_loop and options.qps is None:
+            raise ValueError("--open-loop requires --qps")
+        self.trace_replayer = None
+        self.open_loop_pacer = None
+        self.pacer = None
+        if options.qps is not None:
+            self.pacer = FixedQPSPacer.instance(options.qps, options.qps_distribution)
+
+    def _run_engine(self):
+        # runs until Locust stops the user
+        asyncio.run(self._run())
+
+    async def _run(self):
+        options = self.environment.parsed_options
+        connector = aiohttp.TCPConnector(
+            limit=options.connection_pool_size or 0,
+            force_close=not options.keep_alive,
+        )
+        # Locust doesn't limit the duration of requests either
+        timeout = aiohttp.ClientTimeout(total=None)
+        async with aiohttp.ClientSession(
+            headers=dict(self.client.headers),
+            connector=connector,
+            timeout=timeout,
+            trace_configs=[timed_trace_config()],
+        ) as session:
+            self.session = session
+            if self.pacer is not None:
+                # wakes up the tasks waiting for an arrival when the rate changes, like
+                # FixedQPSPacer.wait does for greenlets
+                loop = asyncio.get_running_loop()
+                self._rate_changed = asyncio.Event()
+                on_rate_change = lambda: loop.call_soon_threadsafe(self._on_rate_change)
+                self.pacer.rate_change_callbacks.append(on_rate_change)
+            if options.open_loop:
+                # arrivals don't depend on the number of users
+                num_users = 1
+                tasks = [asyncio.create_task(self._open_loop())]
+            else:
+                # in distributed mode users are split between workers, as is the spawn rate
+                num_users = options.asyncio_users // InitTracker.worker_count + (
+                    InitTracker.worker_rank
+                    < options.asyncio_users % InitTracker.worker_count
+                )
+                spawn_rate = options.asyncio_spawn_rate / InitTracker.worker_count
+                tasks = []
+                for i in range(num_users):
+                    if i > 0:
+                        await asyncio.sleep(1 / spawn_rate)
+                    tasks.append(asyncio.create_task(self._user_loop()))
+                print(f"All {num_users} asyncio users spawned")
+            InitTracker.notify_users_spawned(num_users)
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                if self.pacer is not None:
+                    self.pacer.rate_change_callbacks.remove(on_rate_change)
+
+    def _on_rate_change(self):
+        rate_changed, self._rate_changed = self._rate_changed, asyncio.Event()
+        rate_changed.set()
+
+    async def _wait_for_arrival(self):
+        while True:
+            rate_changed = self._rate_changed
+            try:
+                await asyncio.wait_for(rate_changed.wait(), self.pacer.wait_time_till_next())
+            except TimeoutError:
+                return
+
+    async def _open_loop(self):
+        # same as LLMUser._dispatch_open_loop_request
+        requests = set()
+        while True:
+            await self._wait_for_arrival()
+            if self._drop_arrival():
+                continue
+            request = asyncio.create_task(self._send_next_request())
+            # the loop keeps only weak references to tasks
+            requests.add(request)
+            request.add_done_callback(requests.discard)
+
+    async def _user_loop(self):
+        options = self.environment.parsed_options
+        if self.pacer is not None:
+            await self._wait_for_arrival()
+        elif not options.burst:
+            # introduce initial delay to avoid all users hitting the service at the same time
+            await asyncio.sleep(random.random())
+        first_done = False
+        while True:
+            t_task_start = time.perf_counter()
+            if await self._send_next_request() and not first_done:
+                first_done = True
+                InitTracker.notify_first_request()
+            if self.pacer is not None:
+                await self._wait_for_arrival()
+            elif options.burst:
+                elapsed = time.perf_counter() - t_task_start
+                await asyncio.sleep(max(0, options.burst - elapsed))
+
+    async def _send_next_request(self):
+        """Samples and sends the next request, returns whether it succeeded."""
+        try:
+            with ClientMonitor.track_request():
+                if not await self._send_request_async(*self._next_request()):
+                    return False
+        except Exception as e:
+            print(f"Request failed: {repr(e)}")
+            self.environment.events.user_error.fire(
+                user_instance=self, exception=e, tb=e.__traceback__
+            )
+            return False
+        if self.environment.parsed_options.open_loop and not self.first_done:
+            self.first_done = True
+            InitTracker.notify_first_request()
+        return True
+
+    async def _send_request_async(
+        self, body, max_tokens, prompt, prompt_usage_tokens, tags
+    ):
+        """Returns False if the request was abandoned, see LLMUser._send_request."""
+        url = self.provider_formatter.get_url()
+        t_start = time.perf_counter()
+        ttft_deadline, total_deadline = self._sample_deadlines()
+        response = None
+        accumulator = None
+        phases = {}
+        try:
+            async with asyncio.timeout_at(
+                self._loop_deadline(
+                    t_start, ttft_deadline if ttft_deadline is not None else total_deadline
+                )
+            ) as timeout:
+                async with self.session.post(
+                    self.host + url, data=body, trace_request_ctx=phases
+                ) as response:
+                    # report the request like Locust does: the response time is measured until the
+                    # headers are received and the event fires once the response is consumed
+                    request_meta = {
+                        "request_type": "POST",
+                        "name": url,
+                        "response_time": (time.perf_counter() - t_start) * 1000,
+                        "response_length": int(response.headers.get("content-length") or 0),
+                        "exception": None,
+                        "context": {},
+                    }
+                    report_request_phases(t_start, phases)
+                    if response.status >= 400:
+                        raise RuntimeError(f"Error in response: {await response.text()}")
+                    accumulator = self._new_accumulator(prompt, prompt_usage_tokens)
+                    data = b""
+                    try:
+                        async for data in response.content.iter_any():
+                            if not accumulator.feed(data, time.perf_counter()):
+                                break
+                            if ttft_deadline is not None and accumulator.t_first_token is not None:
+                                # the first token came in time, only the total deadline is left
+                                ttft_deadline = None
+                                timeout.reschedule(self._loop_deadline(t_start, total_deadline))
+                        data = b""
+                        accumulator.finish(time.perf_counter())
+                    except Exception as e:
+                        print(f"Failed to parse response: {data} with error {repr(e)}")
+                        request_meta["exception"] = e
+                        self.environment.events.request.fire(**request_meta)
+                        self._report_failure(t_start, accumulator, prompt_usage_tokens, tags)
+                        return True
+                    self._report_response(t_start, accumulator, max_tokens, tags)
+                    self.environment.events.request.fire(**request_meta)
+                    return True
+        except TimeoutError:
+            if not timeout.expired():
+                raise
+            # close the connection mid-stream like a client giving up, so the server can cancel
+            if response is not None:
+                response.close()
+            self._report_abandonment(t_start, accumulator, prompt_usage_tokens, tags)
+            return False
+        except Exception:
+            self._report_failure(t_start, accumulator, prompt_usage_tokens, tags)
+            raise
+
+    @staticmethod
+    def _loop_deadline(t_start, deadline):
+        """Converts a deadline relative to `t_start` to the time of the event loop."""
+        if deadline is None:
+            return None
+        return asyncio.get_running_loop().time() + LLMUser._remaining(t_start, deadline)
+
+
+# Locust inherits the tasks of base classes, replace the one of LLMUser
+AsyncLLMUser.tasks = [AsyncLLMUser._run_engine]
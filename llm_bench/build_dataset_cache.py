@@ -0,0 +1,56 @@
+"""
+Pre-build cached limericks datasets for a sweep over several prompt lengths.
+
+Takes the same dataset options as load_test.py and writes one JSONL file per prompt length into
+`.dataset_cache`. Later runs with `--dataset-cache-samples` pick them up instantly, e.g.:
+
+    python build_dataset_cache.py --tokenizer $TOKENIZER --prompt-lengths 512 3000 32000 --dataset-cache-samples 10000
+    locust --tokenizer $TOKENIZER -p 3000 --dataset-cache-samples 10000 ...
+"""
+import os
+import sys
+
+from locust.argument_parser import get_parser
+
+from load_test import DATASET_CACHE_DIR, LimericsDataset
+
+
+def main():
+    parser = get_parser()
+    parser.add_argument(
+        "--prompt-lengths",
+        nargs="+",
+        type=int,
+        required=True,
+        help="Prompt lengths in tokens to build datasets for",
+    )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=None,
+        help="Number of processes to generate prompts with. Defaults to the number of CPUs",
+    )
+    options = parser.parse_args(sys.argv[1:])
+
+    if options.tokenizer is None:
+        raise ValueError("--tokenizer is required to build exact-length datasets")
+    num_samples = options.dataset_cache_samples or 1000
+    limericks_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "limericks.txt")
+
+    for prompt_length in options.prompt_lengths:
+        dataset = LimericsDataset(
+            path=limericks_path,
+            tokenizer_path=options.tokenizer,
+            chat=options.chat,
+            num_tokens=prompt_length,
+            common_tokens=options.prompt_cache_max_len,
+            seed=options.prompt_pool_seed,
+            tokenizer_revision=options.tokenizer_revision,
+        )
+        dataset.generate_cached_jsonl(num_samples, options.num_workers)
+
+    print(f"Datasets for {len(options.prompt_lengths)} prompt lengths are in {DATASET_CACHE_DIR}")
+
+
+if __name__ == "__main__":
+    main()
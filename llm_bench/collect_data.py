@@ -37,6 +37,14 @@ def main():
     parser.add_argument('--tokenizer', help='HF tokenizer for output validation')
     parser.add_argument('--reasoning-effort', type=str, choices=['none', 'low', 'medium', 'high'],
                         help='Reasoning effort for thinking models (e.g., Qwen3)')
+    parser.add_argument('--engine', choices=['locust', 'asyncio'], default='locust',
+                        help='How to simulate workers, asyncio scales to much higher concurrency')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Number of local load generating processes, -1 for one per CPU core')
+    parser.add_argument('--load-shape', choices=['step', 'ramp', 'sine'], default=None,
+                        help='Run all levels as phases of a single test instead of one test per level')
+    parser.add_argument('--warmup', default="20s",
+                        help='Time excluded from the stats at the start of every phase with --load-shape')
 
     args = parser.parse_args()
 
@@ -61,6 +69,21 @@ def main():
         iteration_values = args.concurrency
         iteration_mode = "concurrency"
 
+    if args.load_shape:
+        # a single test steps through the levels and writes every phase into its own results dir
+        cmd = build_cmd(args, api_key, fixed_users if iteration_mode == "qps" else 1)
+        cmd.extend([
+            "--load-shape", args.load_shape,
+            "--load-shape-levels", *[str(value) for value in iteration_values],
+            "--load-shape-phase-duration", duration,
+            "--load-shape-warmup", args.warmup,
+            "--load-shape-output", f"results/{model_name}_in{input_len}_out{output_len}_",
+        ])
+        if iteration_mode == "qps":
+            cmd.extend(["--qps", str(iteration_values[0])])
+        execute_subprocess(cmd)
+        return
+
     for value in iteration_values:
         if iteration_mode == "qps":
             results_dir = f"results/{model_name}_in{input_len}_out{output_len}_{value}qps"
@@ -71,36 +94,14 @@ def main():
 
         os.makedirs(results_dir, exist_ok=True)
 
-        cmd = [
-            LOCUST_BIN,
-            "--headless",
-            "--only-summary",
-            "-H", args.host,
-            "--provider", "fireworks",
-            "--model", args.deployment_id,
-            "--api-key", api_key,
+        cmd = build_cmd(args, api_key, users)
+        cmd.extend([
             "-t", duration,
             "--html", f"{results_dir}/report.html",
             "--csv", f"{results_dir}/stats",
-            "-u", str(users),
-            "-r", str(args.spawn_rate),
-            "-p", str(input_len),
-            "--prompt-cache-max-len", str(args.prompt_cache_max_len),
-            "-o", str(output_len),
-            "--stream"
-        ]
-
-        if args.embeddings:
-            cmd.append("--embeddings")
+        ])
         if iteration_mode == "qps":
             cmd.extend(["--qps", str(value)])
-        if args.tokenizer:
-            cmd.extend(["--tokenizer", args.tokenizer])
-        if args.reasoning_effort:
-            cmd.extend(["--reasoning-effort", args.reasoning_effort])
-
-        locust_file = os.path.join(os.path.dirname(__file__), "load_test.py")
-        cmd.extend(["-f", locust_file])
 
         success = execute_subprocess(cmd)
         if success:
@@ -108,6 +109,37 @@ def main():
         time.sleep(25)
 
 
+def build_cmd(args, api_key, users):
+    cmd = [
+        LOCUST_BIN,
+        "--headless",
+        "--only-summary",
+        "-H", args.host,
+        "--provider", "fireworks",
+        "--model", args.deployment_id,
+        "--api-key", api_key,
+        "-u", str(users),
+        "-r", str(args.spawn_rate),
+        "-p", str(args.prompt_length),
+        "--prompt-cache-max-len", str(args.prompt_cache_max_len),
+        "-o", str(args.output_length),
+        "--stream",
+        "--engine", args.engine,
+        "--processes", str(args.processes),
+    ]
+
+    if args.embeddings:
+        cmd.append("--embeddings")
+    if args.tokenizer:
+        cmd.extend(["--tokenizer", args.tokenizer])
+    if args.reasoning_effort:
+        cmd.extend(["--reasoning-effort", args.reasoning_effort])
+
+    locust_file = os.path.join(os.path.dirname(__file__), "load_test.py")
+    cmd.extend(["-f", locust_file])
+    return cmd
+
+
 def execute_subprocess(cmd):
     print(f"\nExecuting: {' '.join(str(arg) for arg in cmd)}\n")
     process = subprocess.Popen(
@@ -0,0 +1,63 @@
+"""
+Compile a workload into a bundle of pre-serialized request bodies.
+
+Takes the same dataset and provider options as load_test.py and writes a file that can be passed
+to the load test with `--request-bundle`, e.g.:
+
+    python compile_workload.py --provider fireworks -m <model> -p 3000 --chat --bundle-output long.bundle
+    locust --request-bundle long.bundle -o 140 ...
+"""
+import sys
+
+from locust.argument_parser import get_parser
+
+from load_test import PROVIDER_CLASS_MAP, DatasetHolder, RequestBundle
+
+
+def main():
+    parser = get_parser()
+    parser.add_argument(
+        "--bundle-output",
+        required=True,
+        help="Path of the bundle file to write",
+    )
+    parser.add_argument(
+        "--bundle-size",
+        type=int,
+        default=None,
+        help="Number of requests to compile. Defaults to the size of the JSONL dataset or 1000 for generated datasets",
+    )
+    options = parser.parse_args(sys.argv[1:])
+
+    if options.provider is None:
+        raise ValueError("--provider is required to compile a workload")
+    provider_class = PROVIDER_CLASS_MAP[options.provider]
+    model = options.model or provider_class.DEFAULT_MODEL_NAME
+    if model is None:
+        raise ValueError("--model is required to compile a workload")
+    if options.prompt_images_with_resolutions:
+        raise ValueError("Images are not supported in request bundles")
+
+    dataset = DatasetHolder.get_instance(options)
+    num_records = options.bundle_size
+    if num_records is None:
+        if hasattr(dataset, "num_shard_records"):
+            num_records = dataset.num_shard_records
+        elif hasattr(dataset, "__len__"):
+            num_records = len(dataset)
+        else:
+            num_records = 1000
+
+    print(f"Compiling {num_records} requests for {options.provider} model {model}")
+    RequestBundle.compile(
+        options.bundle_output,
+        options.provider,
+        provider_class(model, options),
+        iter(dataset),
+        num_records,
+    )
+    print(f"Bundle written: {options.bundle_output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,33 @@
 import abc
 import argparse
+import array
+import collections
+import contextlib
 import csv
+import hashlib
+import mmap
+import multiprocessing
+import struct
 from dataclasses import dataclass
+import functools
 from functools import partial
 import os
 import random
+import shutil
+import socket
+import subprocess
 import sys
 import traceback
-from typing import Optional
-from locust import HttpUser, task, events, constant_pacing
+from typing import List, Optional, Tuple
+from locust import HttpUser, LoadTestShape, task, events, constant_pacing
+from locust.exception import StopUser
+from locust.runners import LocalRunner, MasterRunner, WorkerRunner
+from locust.stats import PERCENTILES_TO_REPORT, StatsCSV, sort_stats
+from locust.util.timespan import parse_timespan
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import NewConnectionError
 import copy
 import json
 import time
@@ -16,27 +35,67 @@ import orjson
 import base64
 import io
 import itertools
+import math
+import gevent
+import gevent.event
+import gevent.pool
+import gevent.queue
+import gevent.threadpool
+import numpy as np
+import psutil
 from PIL import Image
 import transformers
 
+from metrics import HdrHistogram, MetricsRegistry
+
 try:
     import locust_plugins
 except ImportError:
     print("locust-plugins is not installed, Grafana won't work")
 
 
+# histograms of the metrics, Locust's request stats only hold the actual requests
+METRICS = MetricsRegistry()
+
+
 def add_custom_metric(name, value, length_value=0):
-    events.request.fire(
-        request_type="METRIC",
-        name=name,
-        response_time=value,
-        response_length=length_value,
-        exception=None,
-        context=None,
-    )
+    METRICS.record(name, value, length_value)
+    if InitTracker.environment.parsed_options.metrics_as_requests:
+        events.request.fire(
+            request_type="METRIC",
+            name=name,
+            response_time=value,
+            response_length=length_value,
+            exception=None,
+            context=None,
+        )
+
+
+def add_custom_metric_samples(name, values):
+    """
+    Records many samples of a metric at once, e.g. per token. Unlike `add_custom_metric` they're
+    recorded in one go instead of one by one.
+    """
+    METRICS.record_many(name, values)
+    if InitTracker.environment.parsed_options.metrics_as_requests:
+        stats = InitTracker.environment.stats
+        for value in values:
+            stats.log_request("METRIC", name, value, 0)
 
 
 PROMPT_CHAT_IMAGE_PLACEHOLDER = "<image>"
+# arrivals issued later than that after their scheduled time are reported as late
+LATE_ARRIVAL_THRESHOLD_MS = 10
+
+DATASET_CACHE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), ".dataset_cache"
+)
+
+
+@functools.lru_cache(maxsize=None)
+def load_tokenizer(path: str, revision: Optional[str] = None):
+    """Loads a HF tokenizer once per process, all users of the tokenizer share the instance."""
+    return transformers.AutoTokenizer.from_pretrained(path, revision=revision)
 
 
 class LimericsDataset:
@@ -49,69 +108,187 @@ class LimericsDataset:
         chat: bool,
         num_tokens: int,
         common_tokens: int,
+        seed: Optional[int] = None,
+        tokenizer_revision: Optional[str] = None,
     ):
-        self._tokenizer = transformers.AutoTokenizer.from_pretrained(tokenizer_path)
+        self._tokenizer_path = tokenizer_path
+        self._tokenizer_revision = tokenizer_revision
         self._num_tokens = num_tokens
         self._chat = chat
         self._common_tokens = common_tokens
+        self._random = random.Random(seed)
 
-        self._all_limericks = []
-        with open(path, "r") as f:
-            text = f.read()
-            lims = text.split("\n\n")
-            for i, lim in enumerate(lims):
-                num_tokens = len(self._tokenizer.encode(lim))
-                self._all_limericks.append((lim, num_tokens))
+        with open(path, "rb") as f:
+            data = f.read()
+        lims = data.decode("utf-8").split("\n\n")
+        token_counts = self._load_token_counts(data, lims)
+        self._all_limericks = list(zip(lims, token_counts["limericks"]))
 
         self._prefix = ""
         self._suffix = self._PROMPT
-        self._prefix_suffix_tokens = len(self._tokenizer.encode(self._PROMPT))
+        self._prefix_suffix_tokens = token_counts["prompt"]
         while self._prefix_suffix_tokens < common_tokens:
-            lim, num_tokens = self._all_limericks[
-                random.randint(0, len(self._all_limericks) - 1)
-            ]
+            lim, num_tokens = self._random.choice(self._all_limericks)
             self._prefix += lim + "\n\n"
             self._prefix_suffix_tokens += num_tokens
 
         if chat:
-            empty_tempalate_tokens = self._tokenizer.apply_chat_template(
-                [{"role": "user", "content": ""}],
-                tokenize=True,
-                add_generation_prompt=True,
+            if token_counts["chat_template"] is None:
+                raise ValueError(f"Tokenizer {tokenizer_path} has no chat template")
+            self._prefix_suffix_tokens += token_counts["chat_template"]
+
+    @property
+    def _tokenizer(self):
+        # loaded lazily, with a warm token count cache the tokenizer isn't needed at all
+        return load_tokenizer(self._tokenizer_path, self._tokenizer_revision)
+
+    def _load_token_counts(self, data: bytes, lims: List[str]) -> dict:
+        """
+        Token counts of all limericks, the instruction suffix and the empty chat template.
+
+        Counting is done with a single batched call to the (fast) tokenizer and the result is
+        cached in `.dataset_cache` keyed by the tokenizer and the dataset contents, so it's
+        shared by all Locust processes and repeated runs.
+        """
+        key = hashlib.sha256()
+        for part in [
+            self._tokenizer_path,
+            self._tokenizer_revision or "",
+            self._tokenizer_fingerprint(),
+            self._PROMPT,
+        ]:
+            key.update(part.encode("utf-8") + b"\0")
+        key.update(data)
+        cache_path = os.path.join(
+            DATASET_CACHE_DIR, f"token_counts_{key.hexdigest()[:16]}.json"
+        )
+        if os.path.exists(cache_path):
+            with open(cache_path, "r") as f:
+                return json.load(f)
+
+        start = time.perf_counter()
+        tokenizer = self._tokenizer
+        token_counts = {
+            "limericks": [
+                len(ids)
+                for ids in tokenizer(
+                    [lim + "\n\n" for lim in lims], add_special_tokens=False
+                )["input_ids"]
+            ],
+            # includes special tokens the server adds to the beginning of the prompt
+            "prompt": len(tokenizer.encode(self._PROMPT)),
+            "chat_template": None,
+        }
+        if tokenizer.chat_template is not None:
+            token_counts["chat_template"] = len(
+                tokenizer.apply_chat_template(
+                    [{"role": "user", "content": ""}],
+                    tokenize=True,
+                    add_generation_prompt=True,
+                )
             )
-            self._prefix_suffix_tokens += len(empty_tempalate_tokens)
+        print(
+            f"Tokenized {len(lims)} limericks in {time.perf_counter() - start:.2f}s"
+        )
 
-    def __next__(self):
-        prompt_tokens = self._prefix_suffix_tokens
-        prompt = self._prefix
-        while prompt_tokens < self._num_tokens:
-            lim, num_tokens = self._all_limericks[
-                random.randint(0, len(self._all_limericks) - 1)
-            ]
+        os.makedirs(DATASET_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(token_counts, f)
+        os.replace(tmp_path, cache_path)
+        return token_counts
+
+    def _tokenizer_fingerprint(self) -> str:
+        """Modification times of local tokenizer files, so that edits invalidate the cache."""
+        if not os.path.isdir(self._tokenizer_path):
+            return ""
+        return ",".join(
+            f"{name}:{os.stat(os.path.join(self._tokenizer_path, name)).st_mtime_ns}"
+            for name in sorted(os.listdir(self._tokenizer_path))
+            if name.endswith(".json") or name.endswith(".model")
+        )
 
-            prompt += lim + "\n\n"
-            prompt_tokens += num_tokens
-        prompt += self._suffix
+    def _random_text(self, num_tokens: int):
+        """Random limericks with at least `num_tokens` tokens, returns the text and its token count."""
+        text_tokens = 0
+        # collect the pieces and join once, growing a string with `+=` is quadratic for long prompts
+        parts = []
+        while text_tokens < num_tokens:
+            lim, lim_tokens = self._random.choice(self._all_limericks)
+            parts.append(lim)
+            parts.append("\n\n")
+            text_tokens += lim_tokens
+        return "".join(parts), text_tokens
+
+    def count_tokens(self, text: str) -> int:
+        return len(self._tokenizer.encode(text, add_special_tokens=False))
+
+    def sample(self, num_tokens: int):
+        """Generates a prompt of at least `num_tokens` tokens, returns the prompt and its token count."""
+        body, body_tokens = self._random_text(num_tokens - self._prefix_suffix_tokens)
+        return (
+            "".join((self._prefix, body, self._suffix)),
+            self._prefix_suffix_tokens + body_tokens,
+        )
 
-        return prompt, prompt_tokens
+    def __next__(self):
+        return self.sample(self._num_tokens)
 
     def __iter__(self):
         return self
 
-    def generate_cached_jsonl(self, num_samples: int = 1000) -> str:
+    def _exact_sample(self):
+        """
+        Generates a prompt trimmed to exactly `num_tokens` tokens, returns the prompt and its
+        token count measured by tokenizing the whole prompt (with the chat template in chat mode).
+        """
+        tokenizer = self._tokenizer
+        body, _ = self._random_text(self._num_tokens - self._prefix_suffix_tokens)
+        body_ids = tokenizer.encode(body, add_special_tokens=False)
+        budget = max(0, self._num_tokens - self._prefix_suffix_tokens)
+        # decoding and re-encoding doesn't always round trip, correct the trim a few times
+        for _ in range(5):
+            prompt = (
+                self._prefix + tokenizer.decode(body_ids[:budget]) + self._suffix
+            )
+            if self._chat:
+                prompt_tokens = len(
+                    tokenizer.apply_chat_template(
+                        [{"role": "user", "content": prompt}],
+                        tokenize=True,
+                        add_generation_prompt=True,
+                    )
+                )
+            else:
+                prompt_tokens = len(tokenizer.encode(prompt))
+            if prompt_tokens == self._num_tokens or budget == 0:
+                break
+            budget = max(0, budget + self._num_tokens - prompt_tokens)
+        return prompt, prompt_tokens
+
+    def generate_cached_jsonl(
+        self, num_samples: int = 1000, num_workers: Optional[int] = None
+    ) -> str:
         """
         Generate a cached JSONL dataset file from limericks.
         Returns the path to the generated file.
 
         This allows running the benchmark without needing a tokenizer at runtime,
         while still using realistic text to avoid MoE expert imbalance.
+
+        Prompts are trimmed to exactly `num_tokens` tokens and generated in parallel by
+        `num_workers` processes (defaults to the number of CPUs). Every record stores its token
+        count under `JsonlDataset.PROMPT_TOKENS_KEY`, which `JsonlDataset` reports back.
         """
         # Create cache directory
-        cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".dataset_cache")
+        cache_dir = DATASET_CACHE_DIR
         os.makedirs(cache_dir, exist_ok=True)
 
         # Generate cache filename based on parameters
-        cache_filename = f"limericks_{self._num_tokens}tok_{'chat' if self._chat else 'compl'}_cache{self._common_tokens}.jsonl"
+        tokenizer_key = hashlib.sha1(
+            f"{self._tokenizer_path}:{self._tokenizer_revision}:{self._tokenizer_fingerprint()}".encode()
+        ).hexdigest()[:8]
+        cache_filename = f"limericks_{self._num_tokens}tok_{'chat' if self._chat else 'compl'}_cache{self._common_tokens}_{num_samples}x_{tokenizer_key}.jsonl"
         cache_path = os.path.join(cache_dir, cache_filename)
 
         # Check if cache already exists
@@ -119,37 +296,182 @@ class LimericsDataset:
             print(f"Using cached dataset: {cache_path}")
             return cache_path
 
-        print(f"Generating cached dataset with {num_samples} samples: {cache_path}")
+        num_workers = num_workers or os.cpu_count() or 1
+        print(
+            f"Generating cached dataset with {num_samples} samples using {num_workers} processes: {cache_path}"
+        )
+        start = time.perf_counter()
+
+        # every worker generates a part of the file with its own seed to keep the samples distinct.
+        # Using plain processes rather than multiprocessing.Pool, its helper threads deadlock once
+        # gevent has monkey-patched threading
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        context = multiprocessing.get_context("spawn")
+        workers = []
+        for i in range(num_workers):
+            count = num_samples // num_workers + (i < num_samples % num_workers)
+            if count == 0:
+                continue
+            part_path = f"{tmp_path}.{i}"
+            worker = context.Process(
+                target=_generate_cached_samples,
+                args=(self, self._random.getrandbits(64), count, part_path),
+            )
+            worker.start()
+            workers.append((worker, part_path))
+        with open(tmp_path, "wb") as f:
+            for worker, part_path in workers:
+                worker.join()
+                if worker.exitcode != 0:
+                    raise RuntimeError(
+                        f"Dataset generation worker failed with exit code {worker.exitcode}"
+                    )
+                with open(part_path, "rb") as part:
+                    shutil.copyfileobj(part, f)
+                os.remove(part_path)
+        os.replace(tmp_path, cache_path)
+
+        print(
+            f"Cache generation complete in {time.perf_counter() - start:.2f}s: {cache_path}"
+        )
+        return cache_path
 
-        with open(cache_path, "w") as f:
-            for i in range(num_samples):
-                prompt, actual_tokens = next(self)
 
-                if self._chat:
-                    sample = {"messages": [{"role": "user", "content": prompt}]}
-                else:
-                    sample = {"prompt": prompt}
+def _generate_cached_samples(dataset, seed: int, count: int, path: str):
+    """Worker process for `LimericsDataset.generate_cached_jsonl`, writes `count` records to `path`."""
+    dataset._random = random.Random(seed)
+    with open(path, "w") as f:
+        for _ in range(count):
+            prompt, prompt_tokens = dataset._exact_sample()
+            if dataset._chat:
+                sample = {"messages": [{"role": "user", "content": prompt}]}
+            else:
+                sample = {"prompt": prompt}
+            sample[JsonlDataset.PROMPT_TOKENS_KEY] = prompt_tokens
+            f.write(json.dumps(sample) + "\n")
+    print(f"  Generated {count} samples in {path}")
 
-                f.write(json.dumps(sample) + "\n")
 
-                if (i + 1) % 100 == 0:
-                    print(f"  Generated {i + 1}/{num_samples} samples...")
+class JsonlDataset:
+    """
+    Replays records from a JSONL file without loading it into memory.
 
-        print(f"Cache generation complete: {cache_path}")
-        return cache_path
+    The file is memory-mapped and records are parsed lazily on access. Offsets of all non-empty
+    lines are indexed on first use and the index is cached in `.dataset_cache`, so subsequent runs
+    start instantly and the memory footprint stays flat regardless of the file size.
 
+    The dataset is shared by all users in the process. `shard=(index, count)` restricts it to every
+    `count`-th record starting at `index`, which gives disjoint subsets to different processes.
+    With `shuffle` the records of the shard are visited in a new random order on every pass.
 
-class JsonlDataset:
-    def __init__(self, path: str):
+    Records may carry their prompt token count in `PROMPT_TOKENS_KEY`, it's reported as
+    the prompt length and removed from the request.
+    """
+
+    # Optional field with the number of prompt tokens in the record, it's not sent to the server
+    PROMPT_TOKENS_KEY = "_prompt_tokens"
+    _INDEX_VERSION = 1
+
+    def __init__(
+        self,
+        path: str,
+        shuffle: bool = False,
+        shard: Optional[Tuple[int, int]] = None,
+        seed: Optional[int] = None,
+    ):
         self.path = path
+        self._shuffle = shuffle
+        self._random = random.Random(seed)
+
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                raise ValueError(f"Dataset file {path} is empty")
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        self._offsets = self._load_index()
+        if len(self._offsets) == 0:
+            raise ValueError(f"Dataset file {path} has no records")
+
+        shard_index, shard_count = shard or (0, 1)
+        if not 0 <= shard_index < shard_count:
+            raise ValueError(f"Invalid dataset shard {shard_index}/{shard_count}")
+        self._order = array.array(
+            "Q", range(shard_index, len(self._offsets), shard_count)
+        )
+        if len(self._order) == 0:
+            raise ValueError(
+                f"Dataset shard {shard_index}/{shard_count} of {path} is empty"
+            )
+        self._pos = len(self._order)
+
+    def _index_path(self):
+        st = os.stat(self.path)
+        key = f"{os.path.abspath(self.path)}:{st.st_size}:{st.st_mtime_ns}:{self._INDEX_VERSION}"
+        digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+        return os.path.join(
+            DATASET_CACHE_DIR, f"{os.path.basename(self.path)}.{digest}.idx"
+        )
 
-    def __iter__(self):
-        return itertools.cycle(self._read_data())
+    def _load_index(self):
+        index_path = self._index_path()
+        offsets = array.array("Q")
+        if os.path.exists(index_path):
+            with open(index_path, "rb") as f:
+                offsets.frombytes(f.read())
+            return offsets
+
+        start = time.perf_counter()
+        mm = self._mmap
+        pos = 0
+        size = len(mm)
+        while pos < size:
+            end = mm.find(b"\n", pos)
+            if end == -1:
+                end = size
+            if mm[pos:end].strip():
+                offsets.append(pos)
+            pos = end + 1
+        print(
+            f"Indexed {len(offsets)} records of {self.path} in {time.perf_counter() - start:.2f}s"
+        )
+
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        # write to a temporary file first so that concurrent processes never see a partial index
+        tmp_path = f"{index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            offsets.tofile(f)
+        os.replace(tmp_path, index_path)
+        return offsets
+
+    def __len__(self):
+        return len(self._offsets)
+
+    @property
+    def num_shard_records(self):
+        """Number of records of this shard, the ones replayed by `__next__`."""
+        return len(self._order)
+
+    def __getitem__(self, i):
+        """Parses the record on the `i`-th line of the file, regardless of the shard."""
+        start = self._offsets[i]
+        end = self._mmap.find(b"\n", start)
+        if end == -1:
+            end = len(self._mmap)
+        return orjson.loads(self._view[start:end])
+
+    def __next__(self):
+        if self._pos >= len(self._order):
+            if self._shuffle:
+                self._random.shuffle(self._order)
+            self._pos = 0
+        i = self._order[self._pos]
+        self._pos += 1
+        record = self[i]
+        # the line number identifies the record in the request log
+        return record, record.pop(self.PROMPT_TOKENS_KEY, 0), {"record_id": i}
 
-    def _read_data(self):
-        with open(self.path, "r") as f:
-            for line in f:
-                yield json.loads(line), 0
+    def __iter__(self):
+        return self
 
 
 class DummyTextDataset:
@@ -182,10 +504,12 @@ class LimericsDatasetNoTokenizer:
         num_tokens: int,
         common_tokens: int,
         chat: bool,
+        seed: Optional[int] = None,
     ):
         self._num_tokens = num_tokens
         self._chat = chat
         self._common_tokens = common_tokens
+        self._random = random.Random(seed)
 
         # Load all limericks with estimated token counts
         self._all_limericks = []
@@ -204,7 +528,7 @@ class LimericsDatasetNoTokenizer:
         self._prefix_suffix_tokens = len(self._PROMPT) // 4
 
         while self._prefix_suffix_tokens < common_tokens:
-            lim, num_tokens = random.choice(self._all_limericks)
+            lim, num_tokens = self._random.choice(self._all_limericks)
             self._prefix += lim + "\n\n"
             self._prefix_suffix_tokens += num_tokens
 
@@ -212,60 +536,318 @@ class LimericsDatasetNoTokenizer:
         if chat:
             self._prefix_suffix_tokens += 10  # rough estimate for chat template tokens
 
+    def _random_text(self, num_tokens: int):
+        text_tokens = 0
+        parts = []
+        while text_tokens < num_tokens:
+            lim, lim_tokens = self._random.choice(self._all_limericks)
+            parts.append(lim)
+            parts.append("\n\n")
+            text_tokens += lim_tokens
+        return "".join(parts), text_tokens
+
+    def count_tokens(self, text: str) -> int:
+        return len(text) // 4
+
+    def sample(self, num_tokens: int):
+        body, body_tokens = self._random_text(num_tokens - self._prefix_suffix_tokens)
+        return (
+            "".join((self._prefix, body, self._suffix)),
+            self._prefix_suffix_tokens + body_tokens,
+        )
+
     def __next__(self):
-        prompt_tokens = self._prefix_suffix_tokens
-        prompt = self._prefix
+        return self.sample(self._num_tokens)
 
-        while prompt_tokens < self._num_tokens:
-            lim, num_tokens = random.choice(self._all_limericks)
-            prompt += lim + "\n\n"
-            prompt_tokens += num_tokens
+    def __iter__(self):
+        return self
 
-        prompt += self._suffix
-        return prompt, prompt_tokens
+
+class PromptPool:
+    """
+    Fixed-size pool of prompts pre-generated from another dataset at startup.
+
+    Generating long prompts on the fly costs client CPU inside the load-generating greenlet,
+    which shows up as jitter in TTFT. The pool moves that work to startup so that `__next__`
+    is an O(1) random pick. Token counts are kept in a flat array next to the prompts.
+    """
+
+    def __init__(self, dataset, size: int, seed: Optional[int] = None):
+        assert size > 0, "Prompt pool size must be positive"
+        self._random = random.Random(seed)
+        start = time.perf_counter()
+        prompts = []
+        self._num_tokens = array.array("I")
+        # the record of the underlying dataset if it has ids, the slot of the pool otherwise
+        self._record_ids = array.array("q")
+        for i in range(size):
+            prompt, num_tokens, *tags = next(dataset)
+            prompts.append(prompt)
+            self._num_tokens.append(num_tokens)
+            self._record_ids.append(tags[0].get("record_id", i) if tags else i)
+        self._prompts = tuple(prompts)
+        print(
+            f"Built prompt pool of {size} prompts in {time.perf_counter() - start:.2f}s"
+        )
+
+    def __len__(self):
+        return len(self._prompts)
+
+    def __next__(self):
+        i = self._random.randrange(len(self._prompts))
+        return self._prompts[i], self._num_tokens[i], {"record_id": self._record_ids[i]}
+
+    def __iter__(self):
+        return self
+
+
+class SharedPrefixDataset:
+    """
+    Prompts that start with one of `num_prefixes` shared prefixes of `prefix_tokens` tokens to
+    measure prompt (KV) caching under a mix of tenants.
+
+    With probability `hit_ratio` the prompt reuses a shared prefix picked with a uniform or Zipf
+    distribution, otherwise it gets a unique prefix that can't be cached. The rest of the prompt
+    is random text from the base dataset. Every prompt is returned with tags recording the prefix
+    id and whether the server is expected to have it cached (the first use of every shared prefix
+    is a miss).
+    """
+
+    _HEADER = "Session {:020d}\n\n"
+
+    def __init__(
+        self,
+        base,
+        num_tokens: int,
+        num_prefixes: int,
+        prefix_tokens: int,
+        distribution: str,
+        zipf_alpha: float,
+        hit_ratio: float,
+        seed: Optional[int] = None,
+    ):
+        if not hasattr(base, "sample"):
+            raise ValueError("Shared prefixes are only supported with the 'limerics' dataset")
+        if prefix_tokens <= 0 or prefix_tokens >= num_tokens:
+            raise ValueError(
+                f"Shared prefix length {prefix_tokens} must be positive and shorter than the prompt ({num_tokens} tokens)"
+            )
+        if not 0 <= hit_ratio <= 1:
+            raise ValueError(f"Prefix hit ratio {hit_ratio} must be in range [0, 1]")
+        self._base = base
+        self._num_tokens = num_tokens
+        self._prefix_tokens = prefix_tokens
+        self._hit_ratio = hit_ratio
+        self._random = random.Random(seed)
+        self._header_tokens = base.count_tokens(self._HEADER.format(0))
+
+        if distribution == "uniform":
+            self._cum_weights = None
+        elif distribution == "zipf":
+            self._cum_weights = list(
+                itertools.accumulate(
+                    1 / (k + 1) ** zipf_alpha for k in range(num_prefixes)
+                )
+            )
+        else:
+            raise ValueError(f"Unknown prefix distribution {distribution}")
+
+        self._prefixes = [self._make_prefix(i) for i in range(num_prefixes)]
+        self._used = [False] * num_prefixes
+
+    def _make_prefix(self, prefix_id: int):
+        # the header makes prefixes distinct from the very first token
+        text, num_tokens = self._base._random_text(
+            self._prefix_tokens - self._header_tokens
+        )
+        return self._HEADER.format(prefix_id) + text, self._header_tokens + num_tokens
+
+    def sample(self, num_tokens: int):
+        if self._random.random() < self._hit_ratio:
+            if self._cum_weights is None:
+                prefix_id = self._random.randrange(len(self._prefixes))
+            else:
+                prefix_id = self._random.choices(
+                    range(len(self._prefixes)), cum_weights=self._cum_weights
+                )[0]
+            prefix, prefix_tokens = self._prefixes[prefix_id]
+            hit = self._used[prefix_id]
+            self._used[prefix_id] = True
+        else:
+            # random ids (beyond the shared range) don't repeat across processes and runs
+            prefix_id = self._random.randrange(len(self._prefixes), 10**20)
+            prefix, prefix_tokens = self._make_prefix(prefix_id)
+            hit = False
+        prompt, prompt_tokens = self._base.sample(num_tokens - prefix_tokens)
+        tags = {"prefix_id": prefix_id, "prefix_cache_hit": hit}
+        return prefix + prompt, prefix_tokens + prompt_tokens, tags
+
+    def __next__(self):
+        return self.sample(self._num_tokens)
 
     def __iter__(self):
         return self
 
 
+class ImagePool:
+    """
+    Process-wide pool of pre-encoded images for vision benchmarks.
+
+    Every image slot of the prompt is a list of alternative resolutions. For every resolution the
+    pool holds `pool_size` distinct images with random content, so that the server can't serve
+    repeated images from a cache. Images are generated once per process, JPEG files are cached
+    in `.dataset_cache/images` and held in memory as base64 data URIs shared by all users.
+    """
+
+    _instance = None
+
+    def __init__(
+        self,
+        slots: List[List[Tuple[int, int]]],
+        pool_size: int,
+        seed: Optional[int] = None,
+    ):
+        assert pool_size > 0, "Image pool size must be positive"
+        self._slots = slots
+        self._random = random.Random(seed)
+        seed = seed or 0
+        start = time.perf_counter()
+        self._images = {}
+        for resolution in sorted({res for slot in slots for res in slot}):
+            self._images[resolution] = [
+                self._load_image(*resolution, seed, i) for i in range(pool_size)
+            ]
+        print(
+            f"Prepared {pool_size} images for each of {len(self._images)} resolutions in {time.perf_counter() - start:.2f}s"
+        )
+
+    @classmethod
+    def get_instance(cls, options: argparse.Namespace):
+        if cls._instance is None:
+            cls._instance = cls(
+                options.prompt_images_with_resolutions,
+                options.prompt_images_pool_size,
+                options.prompt_pool_seed,
+            )
+        return cls._instance
+
+    @staticmethod
+    def _load_image(width: int, height: int, seed: int, index: int) -> str:
+        path = os.path.join(
+            DATASET_CACHE_DIR, "images", f"{width}x{height}_{seed}_{index}.jpg"
+        )
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                data = f.read()
+        else:
+            # smooth random content: upscaled noise, it compresses like a natural image would
+            rng = random.Random(f"{width}x{height}:{seed}:{index}")
+            noise_size = (max(1, width // 16), max(1, height // 16))
+            img = Image.frombytes(
+                "RGB", noise_size, rng.randbytes(noise_size[0] * noise_size[1] * 3)
+            ).resize((width, height), Image.BILINEAR)
+            buffer = io.BytesIO()
+            img.save(buffer, format="JPEG")
+            data = buffer.getvalue()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        img_str = base64.b64encode(data).decode("utf-8")
+        return f"data:image/jpeg;base64,{img_str}"
+
+    def __len__(self):
+        return len(self._slots)
+
+    def sample(self) -> List[str]:
+        """Picks a random resolution and a random image for every slot."""
+        return [
+            self._random.choice(self._images[self._random.choice(slot)])
+            for slot in self._slots
+        ]
+
+
 class DatasetHolder:
     _instance = None
 
     @classmethod
     def _create_dataset(cls, options: argparse.Namespace):
         if options.dataset.startswith("@"):
-            return JsonlDataset(options.dataset[1:])
-        elif options.dataset == "limerics":
-            limericks_path = os.path.join(
-                os.path.dirname(os.path.abspath(__file__)), "limericks.txt"
+            return JsonlDataset(
+                options.dataset[1:],
+                shuffle=options.dataset_shuffle,
+                shard=options.dataset_shard,
             )
-
-            # For embeddings without tokenizer, use dummy dataset
-            if options.embeddings and options.tokenizer is None:
-                print("Using DummyTextDataset for embeddings (no tokenizer required)")
-                return DummyTextDataset(num_tokens=options.prompt_tokens)
-
-            # If tokenizer is provided, use accurate tokenization
-            if options.tokenizer is not None:
-                print("Using LimericsDataset with tokenizer for accurate token counts")
-                return LimericsDataset(
-                    path=limericks_path,
-                    tokenizer_path=options.tokenizer,
-                    chat=options.chat,
+        elif options.dataset == "limerics":
+            if options.shared_prefix_count:
+                if options.prompt_pool_size or options.dataset_cache_samples:
+                    raise ValueError(
+                        "--shared-prefix-count can't be combined with --prompt-pool-size or --dataset-cache-samples"
+                    )
+                print(
+                    f"Using {options.shared_prefix_count} shared prefixes of {options.shared_prefix_tokens} tokens"
+                )
+                return SharedPrefixDataset(
+                    cls._create_limerics_dataset(options, common_tokens=0),
                     num_tokens=options.prompt_tokens,
-                    common_tokens=options.prompt_cache_max_len,
+                    num_prefixes=options.shared_prefix_count,
+                    prefix_tokens=options.shared_prefix_tokens,
+                    distribution=options.shared_prefix_distribution,
+                    zipf_alpha=options.shared_prefix_zipf_alpha,
+                    hit_ratio=options.shared_prefix_hit_ratio,
+                    seed=options.prompt_pool_seed,
+                )
+            dataset = cls._create_limerics_dataset(
+                options, common_tokens=options.prompt_cache_max_len
+            )
+            if options.prompt_pool_size:
+                dataset = PromptPool(
+                    dataset, options.prompt_pool_size, options.prompt_pool_seed
                 )
+            return dataset
+        else:
+            raise ValueError(f"Unknown dataset: {options.dataset}")
+
+    @classmethod
+    def _create_limerics_dataset(cls, options: argparse.Namespace, common_tokens: int):
+        limericks_path = os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "limericks.txt"
+        )
 
-            # No tokenizer provided - use limericks with heuristic token counting
-            print("Using LimericsDatasetNoTokenizer (no tokenizer required, using ~4 chars/token heuristic)")
-            return LimericsDatasetNoTokenizer(
+        # For embeddings without tokenizer, use dummy dataset
+        if options.embeddings and options.tokenizer is None:
+            print("Using DummyTextDataset for embeddings (no tokenizer required)")
+            return DummyTextDataset(num_tokens=options.prompt_tokens)
+
+        # If tokenizer is provided, use accurate tokenization
+        if options.tokenizer is not None:
+            print("Using LimericsDataset with tokenizer for accurate token counts")
+            dataset = LimericsDataset(
                 path=limericks_path,
-                num_tokens=options.prompt_tokens,
-                common_tokens=options.prompt_cache_max_len,
+                tokenizer_path=options.tokenizer,
                 chat=options.chat,
+                num_tokens=options.prompt_tokens,
+                common_tokens=common_tokens,
+                seed=options.prompt_pool_seed,
+                tokenizer_revision=options.tokenizer_revision,
             )
-        else:
-            raise ValueError(f"Unknown dataset: {options.dataset}")
+            if options.dataset_cache_samples:
+                path = dataset.generate_cached_jsonl(options.dataset_cache_samples)
+                return JsonlDataset(
+                    path, shuffle=options.dataset_shuffle, shard=options.dataset_shard
+                )
+            return dataset
+
+        # No tokenizer provided - use limericks with heuristic token counting
+        print("Using LimericsDatasetNoTokenizer (no tokenizer required, using ~4 chars/token heuristic)")
+        return LimericsDatasetNoTokenizer(
+            path=limericks_path,
+            num_tokens=options.prompt_tokens,
+            common_tokens=common_tokens,
+            chat=options.chat,
+            seed=options.prompt_pool_seed,
+        )
 
     @classmethod
     def get_instance(cls, options: argparse.Namespace):
@@ -280,25 +862,22 @@ class FixedQPSPacer:
     def __init__(self, qps, distribution):
         self.qps = qps
         self.distribution = distribution
-
-        # It's kind of thread safe thanks to GIL as the only state is `t` - good enough for a loadtest
-        def gen():
-            t = time.time()
-            mean_wait = 1 / self.qps
-            while True:
-                if self.distribution == "exponential":
-                    wait = random.expovariate(1 / mean_wait)
-                elif self.distribution == "uniform":
-                    wait = random.uniform(0, 2 * mean_wait)
-                elif self.distribution == "constant":
-                    wait = mean_wait
-                else:
-                    print("Unknown distribution {self.distribution}")
-                    os._exit(1)
-                t += wait
-                yield t
-
-        self.iterator = gen()
+        # time of the last arrival handed out, all users share the schedule. It's kind of thread
+        # safe thanks to GIL as the only state is `t` - good enough for a loadtest
+        self.t = None
+        # set when the rate changes, users waiting for an arrival take a new one
+        self._rate_changed = gevent.event.Event()
+        # called on rate changes, lets the asyncio engine wake up its tasks
+        self.rate_change_callbacks = []
+
+    def next_arrival(self):
+        if self.t is None:
+            # in distributed mode every worker issues its share of the rate, the starts of
+            # workers are staggered to interleave their requests
+            self.t = time.time() + InitTracker.worker_rank / self.qps
+        mean_wait = InitTracker.worker_count / self.qps
+        self.t += sample_duration(mean_wait, self.distribution)
+        return self.t
 
     @classmethod
     def instance(cls, qps, distribution):
@@ -309,9 +888,45 @@ class FixedQPSPacer:
             assert cls._instance.distribution == distribution
         return cls._instance
 
+    @classmethod
+    def set_qps(cls, qps):
+        """
+        Changes the target rate of a running test. The master forwards the rate to workers.
+        """
+        environment = InitTracker.environment
+        # users spawned later get the new rate too
+        environment.parsed_options.qps = qps
+        if cls._instance is not None:
+            cls._instance._change_rate(qps)
+        if isinstance(environment.runner, MasterRunner):
+            environment.runner.send_message("llm_bench_set_qps", qps)
+
+    def _change_rate(self, qps):
+        now = time.time()
+        if self.t is not None and self.t > now:
+            # the arrivals handed out to idle users were scheduled at the old rate, they're
+            # withdrawn: the users are woken up below and take new ones. The first new arrival of
+            # every worker comes `rank / qps` from now, like at the start
+            self.t = now + (InitTracker.worker_rank - InitTracker.worker_count) / qps
+        self.qps = qps
+        rate_changed, self._rate_changed = self._rate_changed, gevent.event.Event()
+        rate_changed.set()
+        for callback in self.rate_change_callbacks:
+            callback()
+
+    def wait(self):
+        """
+        Blocks the greenlet until its next arrival, returns 0 to be used as Locust's `wait_time`.
+        """
+        while True:
+            rate_changed = self._rate_changed
+            if not rate_changed.wait(self.wait_time_till_next()):
+                return 0
+
     def wait_time_till_next(self):
-        t = next(self.iterator)
+        t = self.next_arrival()
         now = time.time()
+        add_custom_metric("arrival_lateness", max(0, now - t) * 1000)
         if now > t:
             print(
                 f"WARNING: not enough locust users to keep up with the desired QPS. Either the number of locust users is too low or the server is overloaded. Delay: {now-t:.3f}s"
@@ -320,43 +935,174 @@ class FixedQPSPacer:
         return t - now
 
 
+def sample_duration(mean, distribution):
+    """Samples a duration with the given mean from one of the --qps-distribution distributions."""
+    if distribution == "exponential":
+        return random.expovariate(1 / mean)
+    if distribution == "uniform":
+        return random.uniform(0, 2 * mean)
+    return mean
+
+
+@dataclass
+class TraceEntry:
+    time: float
+    input_tokens: int
+    output_tokens: int
+    model: Optional[str]
+    priority: Optional[int]
+
+
+class TraceReplayer:
+    """
+    Replays the arrival times and request lengths of a production trace.
+
+    The trace is a CSV or JSONL file with `timestamp` (seconds, either offsets or absolute times),
+    `input_tokens`, `output_tokens` and optional `model` and `priority` fields. Arrivals are
+    replayed relative to the first request of the trace, `speedup` compresses the time axis.
+    The replayer is shared by all users of the process, as is the group of in-flight requests.
+    """
+
+    _instance = None
+
+    def __init__(self, path: str, speedup: float):
+        assert speedup > 0, "Trace speedup must be positive"
+        self.path = path
+        self.speedup = speedup
+
+        if path.endswith(".csv"):
+            with open(path, "r", newline="") as f:
+                rows = list(csv.DictReader(f))
+        else:
+            with open(path, "r") as f:
+                rows = [json.loads(line) for line in f if line.strip()]
+        if not rows:
+            raise ValueError(f"Trace {path} is empty")
+        try:
+            rows.sort(key=lambda row: float(row["timestamp"]))
+            first = float(rows[0]["timestamp"])
+            self._offsets = array.array(
+                "d", ((float(row["timestamp"]) - first) / speedup for row in rows)
+            )
+            self._input_tokens = array.array("I", (int(row["input_tokens"]) for row in rows))
+            self._output_tokens = array.array(
+                "I", (int(row["output_tokens"]) for row in rows)
+            )
+        except (KeyError, ValueError) as e:
+            raise ValueError(
+                f"Trace {path} must have 'timestamp', 'input_tokens' and 'output_tokens' fields"
+            ) from e
+        if InitTracker.worker_count > 1:
+            # in distributed mode every worker replays its share of the requests
+            shard = slice(InitTracker.worker_rank, None, InitTracker.worker_count)
+            self._offsets = self._offsets[shard]
+            self._input_tokens = self._input_tokens[shard]
+            self._output_tokens = self._output_tokens[shard]
+            rows = rows[shard]
+        self._models = [row.get("model") or None for row in rows]
+        self._priorities = [
+            int(row["priority"]) if row.get("priority") not in (None, "") else None
+            for row in rows
+        ]
+        self._pos = 0
+        self._start = None
+        self.dispatched = 0
+        self.in_flight = gevent.pool.Group()
+        print(
+            f"Loaded trace {path} with {len(rows)} requests over {self._offsets[-1] if rows else 0:.1f}s (speedup {speedup}x)"
+        )
+
+    @classmethod
+    def instance(cls, path, speedup):
+        if cls._instance is None:
+            cls._instance = cls(path, speedup)
+        else:
+            assert cls._instance.path == path
+            assert cls._instance.speedup == speedup
+        return cls._instance
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def next_entry(self) -> Optional[TraceEntry]:
+        """Returns the next request with its scheduled absolute time, or None at the end of the trace."""
+        if self._start is None:
+            self._start = time.time()
+        if self._pos >= len(self._offsets):
+            return None
+        i = self._pos
+        self._pos += 1
+        return TraceEntry(
+            time=self._start + self._offsets[i],
+            input_tokens=self._input_tokens[i],
+            output_tokens=self._output_tokens[i],
+            model=self._models[i],
+            priority=self._priorities[i],
+        )
+
+
 class LengthSampler:
-    def __init__(self, distribution: str, mean: int, cap: Optional[int], alpha: float):
+    """
+    Samples lengths from a (truncated) distribution. Samples are drawn with NumPy in batches
+    ahead of time, so a request only pops a pre-drawn value.
+    """
+
+    _BATCH_SIZE = 1024
+
+    def __init__(
+        self,
+        distribution: str,
+        mean: int,
+        cap: Optional[int],
+        alpha: float,
+        seed: Optional[int] = None,
+    ):
         self.distribution = distribution
         self.mean = mean
         self.cap = cap
         self.alpha = alpha
+        self._rng = np.random.default_rng(seed)
+        self._batch = []
 
         if self.distribution == "exponential":
-            self.sample_func = lambda: int(random.expovariate(1 / self.mean))
+            self.sample_func = lambda n: self._rng.exponential(self.mean, n)
         elif self.distribution == "uniform":
             mx = self.mean + int(self.alpha * self.mean)
             if self.cap is not None:
                 mx = min(mx, self.cap)
-            self.sample_func = lambda: random.randint(
-                max(1, self.mean - int(self.alpha * self.mean)), mx
-            )
+            mn = max(1, self.mean - int(self.alpha * self.mean))
+            self.sample_func = lambda n: self._rng.integers(mn, mx, n, endpoint=True)
         elif self.distribution == "constant":
-            self.sample_func = lambda: self.mean
+            self.sample_func = lambda n: np.full(n, self.mean)
         elif self.distribution == "normal":
-            self.sample_func = lambda: int(
-                random.gauss(self.mean, self.mean * self.alpha)
+            self.sample_func = lambda n: self._rng.normal(
+                self.mean, self.mean * self.alpha, n
             )
         else:
             raise ValueError(f"Unknown distribution {self.distribution}")
 
-    def sample(self) -> int:
+    def _refill(self):
+        batches = []
+        num_samples = 0
         for _ in range(1000):
-            sample = self.sample_func()
-            if sample <= 0:
-                continue
-            if self.cap is not None and sample > self.cap:
-                continue
-            return sample
-        else:
+            batch = self.sample_func(self._BATCH_SIZE).astype(np.int64)
+            batch = batch[batch > 0]
+            if self.cap is not None:
+                batch = batch[batch <= self.cap]
+            batches.append(batch)
+            num_samples += len(batch)
+            if num_samples >= self._BATCH_SIZE:
+                break
+        if num_samples == 0:
             raise ValueError(
                 "Can't sample a value after 1000 attempts, check distribution parameters"
             )
+        self._batch = np.concatenate(batches).tolist()
+
+    def sample(self) -> int:
+        if not self._batch:
+            self._refill()
+        return self._batch.pop()
 
     def __str__(self):
         r = int(self.mean * self.alpha)
@@ -375,26 +1121,193 @@ class LengthSampler:
         return s
 
 
+class JointLengthSampler:
+    """
+    Samples (prompt tokens, output tokens) pairs from an empirical distribution.
+
+    The file is a CSV or JSONL with `prompt_tokens`, `output_tokens` and optional `weight`
+    fields, e.g. a histogram of production traffic. Pairs are sampled jointly, preserving the
+    correlation between input and output lengths, or from the two marginal distributions
+    independently. Like `LengthSampler`, samples are drawn in batches ahead of time.
+    """
+
+    _BATCH_SIZE = 1024
+
+    def __init__(self, path: str, independent: bool = False, seed: Optional[int] = None):
+        self.path = path
+        self.independent = independent
+        self._rng = np.random.default_rng(seed)
+        self._batch = []
+
+        if path.endswith(".csv"):
+            with open(path, "r", newline="") as f:
+                rows = list(csv.DictReader(f))
+        else:
+            with open(path, "r") as f:
+                rows = [json.loads(line) for line in f if line.strip()]
+        try:
+            self._prompt_tokens = np.array(
+                [int(row["prompt_tokens"]) for row in rows], dtype=np.int64
+            )
+            self._output_tokens = np.array(
+                [int(row["output_tokens"]) for row in rows], dtype=np.int64
+            )
+            weights = np.array(
+                [float(row.get("weight") or 1) for row in rows], dtype=np.float64
+            )
+        except (KeyError, ValueError) as e:
+            raise ValueError(
+                f"Length distribution {path} must have 'prompt_tokens' and 'output_tokens' fields"
+            ) from e
+        if len(rows) == 0 or weights.sum() <= 0:
+            raise ValueError(f"Length distribution {path} is empty")
+        if (self._prompt_tokens <= 0).any() or (self._output_tokens <= 0).any():
+            raise ValueError(f"Length distribution {path} has non-positive lengths")
+        self._p = weights / weights.sum()
+
+    def _refill(self):
+        n = len(self._p)
+        prompt_idx = self._rng.choice(n, self._BATCH_SIZE, p=self._p)
+        if self.independent:
+            output_idx = self._rng.choice(n, self._BATCH_SIZE, p=self._p)
+        else:
+            output_idx = prompt_idx
+        self._batch = list(
+            zip(
+                self._prompt_tokens[prompt_idx].tolist(),
+                self._output_tokens[output_idx].tolist(),
+            )
+        )
+
+    def sample(self) -> Tuple[int, int]:
+        """Returns a pair of prompt and output lengths."""
+        if not self._batch:
+            self._refill()
+        return self._batch.pop()
+
+    def __str__(self):
+        kind = "independent" if self.independent else "joint"
+        return f"{kind} empirical({os.path.basename(self.path)})"
+
+
 class InitTracker:
     users = None
     first_request_done = 0
     logging_params = None
     environment = None
     tokenizer = None
+    # position of this process among the workers in distributed mode
+    worker_rank = 0
+    worker_count = 1
+    trace_finished = 0
+    users_spawned = 0
+    users_spawned_reports = 0
+    # phase of the load shape and whether its warm-up is over, for the request log
+    phase = ""
+    measuring = False
 
     @classmethod
-    def notify_init(cls, environment, logging_params):
-        if cls.environment is None:
-            cls.environment = environment
-        if cls.logging_params is None:
-            cls.logging_params = logging_params
-        else:
-            assert (
-                cls.logging_params == logging_params
-            ), f"Inconsistent settings between workers: {cls.logging_params} != {logging_params}"
+    def notify_environment(cls, environment, **kw):
+        """
+        In distributed mode the master tracks the test: workers forward their settings and first
+        requests to it, it splits the load between workers and resets the stats on all of them.
+        """
+        cls.environment = environment
+        runner = environment.runner
+        if isinstance(runner, MasterRunner):
+            runner.register_message(
+                "llm_bench_init",
+                lambda environment, msg: cls.notify_init(environment, msg.data),
+            )
+            runner.register_message(
+                "llm_bench_first_request", lambda msg, **kw: cls.notify_first_request()
+            )
+            runner.register_message(
+                "llm_bench_trace_finished", lambda msg, **kw: cls.notify_trace_finished()
+            )
+            runner.register_message(
+                "llm_bench_users_spawned",
+                lambda msg, **kw: cls.notify_users_spawned(msg.data),
+            )
+            environment.events.test_start.add_listener(cls._send_worker_shares)
+        elif isinstance(runner, WorkerRunner):
+            runner.register_message("llm_bench_worker_share", cls._on_worker_share)
+            runner.register_message("llm_bench_reset_stats", cls._on_reset_stats)
+            runner.register_message(
+                "llm_bench_set_qps", lambda msg, **kw: FixedQPSPacer.set_qps(msg.data)
+            )
+            runner.register_message("llm_bench_phase", lambda msg, **kw: cls.set_phase(msg.data))
+
+    @classmethod
+    def _on_reset_stats(cls, msg, **kw):
+        cls.environment.runner.stats.reset_all()
+        METRICS.reset()
+        cls.measuring = True
+
+    @classmethod
+    def set_phase(cls, label):
+        """Called by the load shape when a phase starts, its requests are warm-up until stats reset."""
+        cls.phase = label
+        cls.measuring = False
+        if isinstance(cls.environment.runner, MasterRunner):
+            cls.environment.runner.send_message("llm_bench_phase", label)
+
+    @classmethod
+    def _send_worker_shares(cls, environment, **kw):
+        # sent before the spawn messages, so workers know their share before users start
+        runner = environment.runner
+        client_ids = sorted(
+            (client.id for client in runner.clients.ready), key=runner.get_worker_index
+        )
+        cls.worker_count = len(client_ids)
+        cls.trace_finished = 0
+        cls.users_spawned = 0
+        cls.users_spawned_reports = 0
+        for rank, client_id in enumerate(client_ids):
+            runner.send_message(
+                "llm_bench_worker_share",
+                {"rank": rank, "count": len(client_ids)},
+                client_id=client_id,
+            )
+
+    @classmethod
+    def _on_worker_share(cls, msg, **kw):
+        cls.worker_rank = msg.data["rank"]
+        cls.worker_count = msg.data["count"]
+        print(f"Worker {cls.worker_rank} of {cls.worker_count} takes its share of the load")
+
+    @classmethod
+    def notify_trace_finished(cls):
+        runner = cls.environment.runner
+        if isinstance(runner, WorkerRunner):
+            if cls.trace_finished == 0:
+                # the master quits once all workers are done, collecting their final stats
+                runner.send_message("llm_bench_trace_finished")
+            cls.trace_finished += 1
+            return
+        cls.trace_finished += 1
+        if cls.trace_finished == cls.worker_count:
+            print("All workers finished the trace")
+            gevent.spawn(runner.quit)
+
+    @classmethod
+    def notify_init(cls, environment, logging_params):
+        if cls.logging_params is None:
+            cls.logging_params = logging_params
+            if isinstance(environment.runner, WorkerRunner):
+                # the master writes the summary
+                environment.runner.send_message("llm_bench_init", logging_params)
+        else:
+            assert (
+                cls.logging_params == logging_params
+            ), f"Inconsistent settings between workers: {cls.logging_params} != {logging_params}"
 
     @classmethod
     def notify_first_request(cls):
+        if isinstance(cls.environment.runner, WorkerRunner):
+            # the master decides when to reset stats
+            cls.environment.runner.send_message("llm_bench_first_request")
+            return
         if (
             cls.environment.parsed_options.qps is not None
             and cls.first_request_done == 0
@@ -413,31 +1326,779 @@ class InitTracker:
     @classmethod
     def notify_spawning_complete(cls, user_count):
         cls.users = user_count
+        if isinstance(cls.environment.runner, WorkerRunner):
+            return
         if cls.users == cls.first_request_done:
             cls.reset_stats()
 
+    @classmethod
+    def notify_users_spawned(cls, user_count):
+        """
+        Called by the asyncio engine, which spawns users by itself, once all of its users started.
+        """
+        runner = cls.environment.runner
+        if isinstance(runner, WorkerRunner):
+            runner.send_message("llm_bench_users_spawned", user_count)
+            return
+        cls.users_spawned += user_count
+        cls.users_spawned_reports += 1
+        if cls.users_spawned_reports == cls.worker_count:
+            cls.notify_spawning_complete(cls.users_spawned)
+
     @classmethod
     def reset_stats(cls):
-        assert cls.environment.runner, "only local mode is supported"
+        if cls.environment.parsed_options.trace:
+            # the whole trace is measured, there's no steady state to wait for
+            return
+        if cls.environment.parsed_options.load_shape:
+            # every phase waits for its own warm-up
+            return
         print("Resetting stats after traffic reach a steady state")
+        cls.clear_stats()
+
+    @classmethod
+    def clear_stats(cls):
         cls.environment.events.reset_stats.fire()
         cls.environment.runner.stats.reset_all()
+        cls.measuring = True
+        if isinstance(cls.environment.runner, MasterRunner):
+            # drop what workers collected but haven't reported yet
+            cls.environment.runner.send_message("llm_bench_reset_stats")
 
     @classmethod
-    def load_tokenizer(cls, dir):
+    def load_tokenizer(cls, dir, revision=None):
         if not dir:
             return None
         if cls.tokenizer:
             return cls.tokenizer
-        import transformers
-
-        cls.tokenizer = transformers.AutoTokenizer.from_pretrained(dir)
-        cls.tokenizer.add_bos_token = False
-        cls.tokenizer.add_eos_token = False
+        # shares the instance with the dataset, count output tokens with `add_special_tokens=False`
+        cls.tokenizer = load_tokenizer(dir, revision)
         return cls.tokenizer
 
 
+events.init.add_listener(InitTracker.notify_environment)
 events.spawning_complete.add_listener(InitTracker.notify_spawning_complete)
+events.reset_stats.add_listener(METRICS.reset)
+
+
+@events.spawning_complete.add_listener
+def _(user_count):
+    # Locust's --reset-stats resets its request stats without firing reset_stats
+    if InitTracker.environment.reset_stats:
+        METRICS.reset()
+        # every phase of a load shape is measured once its warm-up is over
+        if not InitTracker.environment.parsed_options.load_shape:
+            InitTracker.measuring = True
+
+
+@events.report_to_master.add_listener
+def _(client_id, data):
+    # like Locust's request stats, workers send what they collected since the previous report
+    data["llm_bench_metrics"] = METRICS.serialize()
+    METRICS.histograms = {}
+
+
+@events.worker_report.add_listener
+def _(client_id, data):
+    METRICS.merge_serialized(data.get("llm_bench_metrics", {}))
+
+
+def _requests_data_rows(self, csv_writer):
+    """
+    Replaces the rows of `StatsCSV`, so that stats_stats.csv reads the metrics from their
+    histograms. They keep the columns of requests: the percentiles are exact to the microsecond
+    instead of rounded to 2 significant digits, the content size is the weight of the metric.
+    """
+    stats = self.environment.stats
+    for entry in sort_stats(stats.entries):
+        if entry.method != "METRIC":
+            csv_writer.writerow(self._stats_entry_row(entry))
+    for name in sorted(METRICS.histograms):
+        histogram = METRICS.histograms[name]
+        csv_writer.writerow(
+            [
+                "METRIC",
+                name,
+                histogram.count,
+                0,
+                round(histogram.percentile(0.5), 3),
+                histogram.mean,
+                histogram.min,
+                histogram.max,
+                histogram.avg_length,
+                METRICS.rate(name),
+                0,
+            ]
+            + [round(histogram.percentile(q), 3) for q in self.percentiles_to_report]
+        )
+    csv_writer.writerow(self._stats_entry_row(stats.total))
+
+
+def _stats_entry_row(self, entry):
+    return [
+        entry.method,
+        entry.name,
+        entry.num_requests,
+        entry.num_failures,
+        entry.median_response_time,
+        entry.avg_response_time,
+        entry.min_response_time or 0,
+        entry.max_response_time,
+        entry.avg_content_length,
+        entry.total_rps,
+        entry.total_fail_per_sec,
+    ] + self._percentile_fields(entry)
+
+
+StatsCSV._requests_data_rows = _requests_data_rows
+StatsCSV._stats_entry_row = _stats_entry_row
+
+
+class ClientMonitor:
+    """
+    Samples the load of the load generator itself: CPU usage of the process, scheduling lag of
+    greenlets (and of the asyncio engine running on top of them) and the number of requests in
+    flight. Together with the lateness of paced arrivals it tells whether the client rather than
+    the server was the bottleneck of the run.
+    """
+
+    LAG_SAMPLE_INTERVAL = 0.1
+    CPU_SAMPLE_INTERVAL = 1.0
+    # a run is flagged as client-saturated if any of the thresholds is exceeded
+    CPU_PERCENT_P90_THRESHOLD = 90
+    LOOP_LAG_P99_THRESHOLD_MS = 50
+    ARRIVAL_LATENESS_P90_THRESHOLD_MS = 50
+
+    in_flight = 0
+    _greenlet = None
+
+    @classmethod
+    @contextlib.contextmanager
+    def track_request(cls):
+        cls.in_flight += 1
+        TimeSeriesRecorder.count("requests_started")
+        try:
+            yield
+        finally:
+            cls.in_flight -= 1
+
+    @classmethod
+    def start(cls, environment, **kw):
+        # the master doesn't generate load
+        if isinstance(environment.runner, MasterRunner) or cls._greenlet is not None:
+            return
+        cls._greenlet = gevent.spawn(cls._run)
+
+    @classmethod
+    def stop(cls, **kw):
+        if cls._greenlet is not None:
+            cls._greenlet.kill(block=False)
+            cls._greenlet = None
+
+    @classmethod
+    def _run(cls):
+        process = psutil.Process()
+        process.cpu_percent()
+        t_cpu_sample = time.perf_counter()
+        while True:
+            t_start = time.perf_counter()
+            gevent.sleep(cls.LAG_SAMPLE_INTERVAL)
+            now = time.perf_counter()
+            lag = max(0, now - t_start - cls.LAG_SAMPLE_INTERVAL)
+            add_custom_metric("client_loop_lag", lag * 1000)
+            if now - t_cpu_sample >= cls.CPU_SAMPLE_INTERVAL:
+                t_cpu_sample = now
+                add_custom_metric("client_cpu_percent", process.cpu_percent())
+                add_custom_metric("client_in_flight", cls.in_flight)
+
+    @classmethod
+    def saturation_reasons(cls, metrics) -> List[str]:
+        """Returns why the client looks saturated according to the collected samples."""
+        checks = [
+            ("client_cpu_percent", 0.9, cls.CPU_PERCENT_P90_THRESHOLD, "P90 CPU usage {:.0f}%"),
+            ("client_loop_lag", 0.99, cls.LOOP_LAG_P99_THRESHOLD_MS, "P99 scheduling lag {:.0f} ms"),
+            ("arrival_lateness", 0.9, cls.ARRIVAL_LATENESS_P90_THRESHOLD_MS, "P90 arrival lateness {:.0f} ms"),
+        ]
+        reasons = []
+        for metric_name, percentile, threshold, message in checks:
+            histogram = metrics.get(metric_name)
+            if histogram.count == 0:
+                continue
+            value = histogram.percentile(percentile)
+            if value >= threshold:
+                reasons.append(message.format(value))
+        return reasons
+
+
+events.test_start.add_listener(ClientMonitor.start)
+events.test_stop.add_listener(ClientMonitor.stop)
+
+
+class OutputValidator:
+    """
+    Counts the tokens of responses with `--tokenizer`, enabled with `--validate-output`.
+
+    Tokenizing inline would add CPU time to the measured latencies of concurrent requests, so
+    finished responses are queued along with their timings and tokenized in batches on a thread of
+    the gevent hub (fast tokenizers release the GIL). The counts are checked against the ones
+    reported by the provider and `max_tokens`, and stand in for them if the provider reported none.
+    """
+
+    BATCH_SIZE = 64
+    # responses are dropped rather than piling up if the tokenizer can't keep up
+    MAX_QUEUED = 10000
+    DRAIN_TIMEOUT = 10
+
+    _queue = None
+    _greenlet = None
+    _tokenizer = None
+
+    @classmethod
+    def submit(cls, text, reported_tokens, max_tokens, dur_generation, dur_total):
+        if cls._queue is None:
+            cls._queue = gevent.queue.JoinableQueue()
+        if cls._greenlet is None:
+            cls._greenlet = gevent.spawn(cls._run)
+        if cls._queue.qsize() >= cls.MAX_QUEUED:
+            add_custom_metric("tokenizer_dropped", 1)
+            return
+        cls._queue.put_nowait(
+            (text, reported_tokens, max_tokens, dur_generation, dur_total)
+        )
+
+    @classmethod
+    def stop(cls, **kw):
+        """Waits for the queued responses, so they make it into the final stats."""
+        if cls._greenlet is None:
+            return
+        if not cls._queue.join(timeout=cls.DRAIN_TIMEOUT):
+            print(f"WARNING: {cls._queue.qsize()} responses weren't tokenized in time")
+        cls._greenlet.kill(block=False)
+        cls._greenlet = None
+
+    @classmethod
+    def _run(cls):
+        options = InitTracker.environment.parsed_options
+        threadpool = gevent.get_hub().threadpool
+        if cls._tokenizer is None:
+            cls._tokenizer = threadpool.apply(
+                InitTracker.load_tokenizer,
+                (options.tokenizer, options.tokenizer_revision),
+            )
+        while True:
+            batch = [cls._queue.get()]
+            while len(batch) < cls.BATCH_SIZE and not cls._queue.empty():
+                batch.append(cls._queue.get_nowait())
+            try:
+                counts = threadpool.apply(cls._count_tokens, ([item[0] for item in batch],))
+                for item, num_tokens in zip(batch, counts):
+                    cls._report(num_tokens, *item[1:])
+            except Exception as e:
+                print(f"Failed to tokenize responses: {repr(e)}")
+            finally:
+                for _ in batch:
+                    cls._queue.task_done()
+
+    @classmethod
+    def _count_tokens(cls, texts):
+        return [
+            len(ids)
+            for ids in cls._tokenizer(texts, add_special_tokens=False)["input_ids"]
+        ]
+
+    @staticmethod
+    def _report(num_tokens, reported_tokens, max_tokens, dur_generation, dur_total):
+        add_custom_metric("tokenizer_num_tokens", num_tokens)
+        if reported_tokens and reported_tokens != num_tokens:
+            # re-tokenized text doesn't always split like the generated tokens, expect small differences
+            add_custom_metric("tokenizer_mismatch", abs(reported_tokens - num_tokens))
+        if num_tokens != max_tokens:
+            add_custom_metric("max_tokens_mismatch", abs(max_tokens - num_tokens))
+        if not reported_tokens and num_tokens:
+            # the provider reported no usage nor logprobs, the timings were taken on arrival
+            add_custom_metric("num_tokens", num_tokens)
+            add_custom_metric(
+                "latency_per_token", dur_generation / num_tokens * 1000, num_tokens
+            )
+            add_custom_metric(
+                "overall_latency_per_token", dur_total / num_tokens * 1000, num_tokens
+            )
+
+
+events.test_stop.add_listener(OutputValidator.stop)
+
+
+class TimeSeriesRecorder:
+    """
+    Records throughput and latency per second of wall-clock time, enabled with `--timeseries-file`.
+
+    Every process counts requests and tokens and collects TTFT and inter-token latency histograms
+    in one bucket per second. Workers send the buckets of past seconds to the master with their
+    stats reports, the master (or the local runner) merges them and writes a row per second a few
+    seconds behind, once all workers reported it. Only the buckets not written yet and the ones of
+    the rolling percentile window are kept, rows are written to the Parquet or Arrow IPC file in
+    batches. Unlike the summary, the time series covers the whole test including the warm-up.
+    """
+
+    COUNTERS = [
+        "requests_started",
+        "requests_completed",
+        "requests_failed",
+        "requests_abandoned",
+        "output_tokens",
+        "prompt_tokens",
+        "in_flight",
+    ]
+    HISTOGRAMS = ["ttft", "itl"]
+    # workers report every 3 seconds
+    WRITE_LAG = 5
+    ROWS_PER_BATCH = 60
+
+    enabled = False
+    buckets = {}
+    _greenlet = None
+    _writer = None
+    _rows = None
+    _window = None
+    _next_second = None
+    _first_second = None
+
+    @classmethod
+    def _bucket(cls):
+        second = int(time.time())
+        bucket = cls.buckets.get(second)
+        if bucket is None:
+            bucket = cls.buckets[second] = cls._new_bucket()
+        return bucket
+
+    @classmethod
+    def _new_bucket(cls):
+        bucket = dict.fromkeys(cls.COUNTERS, 0)
+        for name in cls.HISTOGRAMS:
+            bucket[name] = HdrHistogram()
+        return bucket
+
+    @classmethod
+    def count(cls, counter, value=1):
+        if cls.enabled:
+            cls._bucket()[counter] += value
+
+    @classmethod
+    def record_response(cls, num_tokens, prompt_tokens, ttft, inter_token_latencies):
+        if not cls.enabled:
+            return
+        bucket = cls._bucket()
+        bucket["requests_completed"] += 1
+        bucket["output_tokens"] += num_tokens
+        bucket["prompt_tokens"] += prompt_tokens or 0
+        if ttft is not None:
+            bucket["ttft"].record(ttft)
+        if inter_token_latencies is not None:
+            bucket["itl"].record_many(inter_token_latencies)
+
+    @classmethod
+    def start(cls, environment, **kw):
+        options = environment.parsed_options
+        cls.enabled = options.timeseries_file is not None
+        if not cls.enabled or cls._greenlet is not None:
+            return
+        cls._greenlet = gevent.spawn(cls._run, environment)
+
+    @classmethod
+    def _run(cls, environment):
+        while True:
+            gevent.sleep(1)
+            if not isinstance(environment.runner, MasterRunner):
+                # summed over processes, the master has no requests of its own
+                cls._bucket()["in_flight"] = ClientMonitor.in_flight
+            if not isinstance(environment.runner, WorkerRunner):
+                cls._write_until(int(time.time()) - cls.WRITE_LAG, environment)
+
+    @classmethod
+    def report_to_master(cls, client_id, data):
+        if not cls.enabled:
+            return
+        # the current second too, the master adds up what arrives before it writes the row
+        buckets, cls.buckets = cls.buckets, {}
+        data["llm_bench_timeseries"] = {
+            second: {
+                name: value.serialize() if name in cls.HISTOGRAMS else value
+                for name, value in bucket.items()
+            }
+            for second, bucket in buckets.items()
+        }
+
+    @classmethod
+    def worker_report(cls, client_id, data):
+        for second, worker_bucket in data.get("llm_bench_timeseries", {}).items():
+            second = int(second)
+            if cls._next_second is not None and second < cls._next_second:
+                # reported too late, the row is written already
+                continue
+            bucket = cls.buckets.get(second)
+            if bucket is None:
+                bucket = cls.buckets[second] = cls._new_bucket()
+            for name, value in worker_bucket.items():
+                if name in cls.HISTOGRAMS:
+                    bucket[name].merge(HdrHistogram.unserialize(value))
+                else:
+                    bucket[name] += value
+
+    @classmethod
+    def _write_until(cls, last_second, environment):
+        """Turns the buckets up to `last_second` into rows, filling gaps with empty seconds."""
+        if cls._next_second is None:
+            if not cls.buckets:
+                return
+            cls._first_second = cls._next_second = min(cls.buckets)
+            cls._rows = {name: [] for name in cls._columns()}
+            cls._window = collections.deque(
+                maxlen=environment.parsed_options.timeseries_window
+            )
+        while cls._next_second <= last_second:
+            bucket = cls.buckets.pop(cls._next_second, None) or cls._new_bucket()
+            cls._window.append(bucket)
+            row = {
+                "timestamp": cls._next_second,
+                "elapsed": cls._next_second - cls._first_second,
+            }
+            row.update((name, bucket[name]) for name in cls.COUNTERS)
+            for name in cls.HISTOGRAMS:
+                window = HdrHistogram()
+                for window_bucket in cls._window:
+                    window.merge(window_bucket[name])
+                for q in (50, 99):
+                    row[f"{name}_p{q}"] = window.percentile(q / 100) if window.count else None
+            for name, value in row.items():
+                cls._rows[name].append(value)
+            cls._next_second += 1
+            if len(cls._rows["timestamp"]) >= cls.ROWS_PER_BATCH:
+                cls._flush(environment)
+
+    @classmethod
+    def _columns(cls):
+        return (
+            ["timestamp", "elapsed"]
+            + cls.COUNTERS
+            + [f"{name}_p{q}" for name in cls.HISTOGRAMS for q in (50, 99)]
+        )
+
+    @classmethod
+    def _flush(cls, environment):
+        import pyarrow as pa
+
+        path = environment.parsed_options.timeseries_file
+        table = pa.table(cls._rows).cast(
+            pa.schema(
+                [("timestamp", pa.timestamp("s", tz="UTC")), ("elapsed", pa.int64())]
+                + [(name, pa.int64()) for name in cls.COUNTERS]
+                + [(name, pa.float64()) for name in cls._columns()[2 + len(cls.COUNTERS) :]]
+            )
+        )
+        if cls._writer is None:
+            if path.endswith((".arrow", ".feather", ".ipc")):
+                cls._writer = pa.ipc.new_file(path, table.schema)
+            else:
+                import pyarrow.parquet as pq
+
+                cls._writer = pq.ParquetWriter(path, table.schema)
+        cls._writer.write_table(table)
+        cls._rows = {name: [] for name in cls._columns()}
+
+    @classmethod
+    def close(cls, environment, **kw):
+        """Writes the remaining seconds, the final reports of workers are in by now."""
+        if not cls.enabled or isinstance(environment.runner, WorkerRunner):
+            return
+        if cls._greenlet is not None:
+            cls._greenlet.kill(block=False)
+            cls._greenlet = None
+        if cls.buckets:
+            cls._write_until(max(cls.buckets), environment)
+        if cls._rows and cls._rows["timestamp"]:
+            cls._flush(environment)
+        if cls._writer is not None:
+            cls._writer.close()
+            cls._writer = None
+            print(f"Time series written to {environment.parsed_options.timeseries_file}")
+
+
+events.test_start.add_listener(TimeSeriesRecorder.start)
+events.report_to_master.add_listener(TimeSeriesRecorder.report_to_master)
+events.worker_report.add_listener(TimeSeriesRecorder.worker_report)
+events.quitting.add_listener(TimeSeriesRecorder.close)
+
+
+class RequestLog:
+    """
+    Raw record of every request, enabled with `--request-log`.
+
+    A record is a handful of stores into the preallocated columns of a fixed-size batch, strings
+    (provider, model, phase) are stored as codes. Full batches are handed to a writer thread that
+    converts them to Arrow and appends them to the Parquet (or Arrow IPC) file, so encoding and I/O
+    don't hold up the greenlets sending requests. In distributed mode every worker writes its own
+    file.
+    """
+
+    BATCH_SIZE = 4096
+    STATUSES = ["completed", "failed", "abandoned"]
+    COLUMNS = {
+        "start_time": np.float64,
+        "ttft": np.float64,
+        "end_time": np.float64,
+        "prompt_tokens": np.int64,
+        "output_tokens": np.int64,
+        "status": np.uint8,
+        "provider": np.int32,
+        "model": np.int32,
+        "record_id": np.int64,
+        "phase": np.int32,
+        "warmup": np.bool_,
+    }
+
+    enabled = False
+    _batch = None
+    _size = 0
+    _labels = {}
+    _threadpool = None
+    _writer = None
+    _path = None
+    _clock_offset = 0.0
+
+    @classmethod
+    def start(cls, environment, **kw):
+        options = environment.parsed_options
+        if options.request_log is None or isinstance(environment.runner, MasterRunner):
+            return
+        if cls._threadpool is not None:
+            return
+        if options.trace:
+            # the whole trace is measured
+            InitTracker.measuring = True
+        cls._path = options.request_log
+        if isinstance(environment.runner, WorkerRunner):
+            root, ext = os.path.splitext(cls._path)
+            cls._path = f"{root}.worker{InitTracker.worker_rank}{ext}"
+        # a single thread writes the batches in order
+        cls._threadpool = gevent.threadpool.ThreadPool(1)
+        # requests are timed with perf_counter(), the log has wall clock times
+        cls._clock_offset = time.time() - time.perf_counter()
+        cls._batch = cls._new_batch()
+        cls.enabled = True
+
+    @classmethod
+    def _new_batch(cls):
+        return {name: np.empty(cls.BATCH_SIZE, dtype) for name, dtype in cls.COLUMNS.items()}
+
+    @classmethod
+    def _code(cls, label):
+        code = cls._labels.get(label)
+        if code is None:
+            code = cls._labels[label] = len(cls._labels)
+        return code
+
+    @classmethod
+    def log(cls, status, t_start, t_first_token, prompt_tokens, output_tokens, provider, model, tags):
+        if not cls.enabled:
+            return
+        batch, i = cls._batch, cls._size
+        batch["start_time"][i] = t_start
+        batch["ttft"][i] = math.nan if t_first_token is None else (t_first_token - t_start) * 1000
+        batch["end_time"][i] = time.perf_counter()
+        # negative values are written as nulls
+        batch["prompt_tokens"][i] = -1 if prompt_tokens is None else prompt_tokens
+        batch["output_tokens"][i] = -1 if output_tokens is None else output_tokens
+        batch["status"][i] = cls.STATUSES.index(status)
+        batch["provider"][i] = cls._code(provider)
+        batch["model"][i] = cls._code(tags.get("model", model))
+        batch["record_id"][i] = tags.get("record_id", -1)
+        batch["phase"][i] = cls._code(InitTracker.phase)
+        batch["warmup"][i] = not InitTracker.measuring
+        cls._size = i + 1
+        if cls._size == cls.BATCH_SIZE:
+            cls._submit()
+
+    @classmethod
+    def _submit(cls):
+        batch, size = cls._batch, cls._size
+        cls._batch, cls._size = cls._new_batch(), 0
+        # codes only grow, the labels known now cover the batch
+        cls._threadpool.spawn(cls._write, batch, size, list(cls._labels))
+
+    @classmethod
+    def _write(cls, batch, size, labels):
+        try:
+            import pyarrow as pa
+
+            batch = {name: values[:size] for name, values in batch.items()}
+            labels = np.array(labels, dtype=object)
+
+            def timestamps(values):
+                return pa.array(
+                    ((values + cls._clock_offset) * 1e6).astype(np.int64),
+                    pa.timestamp("us", tz="UTC"),
+                )
+
+            def nullable(values):
+                return pa.array(values, mask=values < 0)
+
+            table = pa.table(
+                {
+                    "start_time": timestamps(batch["start_time"]),
+                    "ttft_ms": pa.array(batch["ttft"], from_pandas=True),
+                    "end_time": timestamps(batch["end_time"]),
+                    "prompt_tokens": nullable(batch["prompt_tokens"]),
+                    "output_tokens": nullable(batch["output_tokens"]),
+                    "status": pa.array(np.array(cls.STATUSES, dtype=object)[batch["status"]]),
+                    "provider": pa.array(labels[batch["provider"]], pa.string()),
+                    "model": pa.array(labels[batch["model"]], pa.string()),
+                    "record_id": nullable(batch["record_id"]),
+                    "phase": pa.array(labels[batch["phase"]], pa.string()),
+                    "warmup": pa.array(batch["warmup"]),
+                }
+            )
+            if cls._writer is None:
+                if cls._path.endswith((".arrow", ".feather", ".ipc")):
+                    cls._writer = pa.ipc.new_file(cls._path, table.schema)
+                else:
+                    import pyarrow.parquet as pq
+
+                    cls._writer = pq.ParquetWriter(cls._path, table.schema)
+            cls._writer.write_table(table)
+        except Exception as e:
+            print(f"Failed to write the request log: {repr(e)}")
+
+    @classmethod
+    def close(cls, **kw):
+        if not cls.enabled:
+            return
+        cls.enabled = False
+        if cls._size:
+            cls._submit()
+        # runs after the pending batches
+        cls._threadpool.spawn(cls._close_writer).get()
+        cls._threadpool.kill()
+        cls._threadpool = None
+
+    @classmethod
+    def _close_writer(cls):
+        if cls._writer is not None:
+            cls._writer.close()
+            cls._writer = None
+            print(f"Request log written to {cls._path}")
+
+
+events.test_start.add_listener(RequestLog.start)
+events.quitting.add_listener(RequestLog.close)
+
+
+class PhasedLoadShape(LoadTestShape):
+    """
+    Steps through concurrency or QPS levels in a single run, enabled with `--load-shape`. Every
+    level is a phase: stats are reset once its warm-up is over and summarized when it ends, so the
+    dataset, the tokenizer and warm connections are reused across a whole sweep.
+    """
+
+    # enabled by the option rather than picked up from the locustfile by Locust
+    abstract = True
+
+    def __init__(self, environment):
+        super().__init__()
+        options = environment.parsed_options
+        self.environment = environment
+        self.kind = options.load_shape
+        self.levels = options.load_shape_levels
+        self.phase_duration = parse_timespan(options.load_shape_phase_duration)
+        self.warmup = parse_timespan(options.load_shape_warmup)
+        self.qps_mode = options.qps is not None
+        self.phase = None
+        self.measuring = False
+        self.last_qps = None
+        self.summaries = []
+        self.failed = False
+        if not self.levels or min(self.levels) <= 0:
+            raise ValueError("--load-shape requires positive --load-shape-levels")
+        if not self.qps_mode:
+            if any(not level.is_integer() for level in self.levels):
+                raise ValueError("Concurrency --load-shape-levels must be integers")
+            self.levels = [int(level) for level in self.levels]
+        if self.warmup >= self.phase_duration:
+            raise ValueError(
+                "--load-shape-warmup must be shorter than --load-shape-phase-duration"
+            )
+        if not 0 <= options.load_shape_sine_amplitude < 1:
+            raise ValueError("--load-shape-sine-amplitude must be in [0, 1)")
+
+    def phase_label(self, phase):
+        return f"{self.levels[phase]:g}{'qps' if self.qps_mode else 'u'}"
+
+    def level(self, phase, t):
+        """Target concurrency or QPS `t` seconds into the phase."""
+        options = self.environment.parsed_options
+        target = self.levels[phase]
+        if self.kind == "ramp" and t < self.warmup and phase > 0:
+            # move from the previous level over the warm-up instead of jumping
+            previous = self.levels[phase - 1]
+            return previous + (target - previous) * t / self.warmup
+        if self.kind == "sine":
+            return target * (
+                1
+                + options.load_shape_sine_amplitude
+                * math.sin(2 * math.pi * t / parse_timespan(options.load_shape_sine_period))
+            )
+        return target
+
+    def tick(self):
+        options = self.environment.parsed_options
+        run_time = self.get_run_time()
+        phase = int(run_time // self.phase_duration)
+        if phase != self.phase:
+            if phase >= len(self.levels):
+                # the last phase is summarized on quit, once workers sent their final stats
+                return None
+            self.finish_phase()
+            self.phase = phase
+            print(f"Load shape phase {phase + 1}/{len(self.levels)}: {self.phase_label(phase)}")
+            InitTracker.set_phase(self.phase_label(phase))
+        t = run_time - phase * self.phase_duration
+        if not self.measuring and t >= self.warmup:
+            print(f"Resetting stats after the warm-up of phase {self.phase_label(phase)}")
+            InitTracker.clear_stats()
+            self.measuring = True
+        level = self.level(phase, t)
+        if self.qps_mode:
+            if level != self.last_qps:
+                FixedQPSPacer.set_qps(level)
+                self.last_qps = level
+            return options.num_users, options.spawn_rate
+        return max(1, round(level)), options.spawn_rate
+
+    def finish_phase(self):
+        """Summarizes the current phase if it's past its warm-up."""
+        if not self.measuring:
+            return
+        self.measuring = False
+        options = self.environment.parsed_options
+        label = self.phase_label(self.phase)
+        level = self.levels[self.phase]
+        entries = summary_entries(
+            self.environment,
+            f"QPS {level:g} {options.qps_distribution}" if self.qps_mode else level,
+        )
+        if entries is None:
+            print(f"Phase {label} failed due to failed requests")
+            self.failed = True
+            return
+        self.summaries.append(entries)
+        if options.summary_file:
+            write_summary_file(options.summary_file, entries)
+        if options.load_shape_output:
+            # same layout as the directories of collect_data.py runs
+            results_dir = f"{options.load_shape_output}{label}"
+            os.makedirs(results_dir, exist_ok=True)
+            with open(os.path.join(results_dir, "stats_stats.csv"), "w", newline="") as f:
+                StatsCSV(self.environment, PERCENTILES_TO_REPORT).requests_csv(csv.writer(f))
+            print(f"Stats of phase {label} written to {results_dir}")
 
 
 @dataclass
@@ -649,6 +2310,290 @@ PROVIDER_CLASS_MAP = {
 }
 
 
+class SSEDecoder:
+    """
+    Incremental decoder of a server-sent events stream. Events are parsed in place from the
+    received bytes and their data is returned as memoryviews into them, only an incomplete event
+    at the end of a read is copied and carried over to the next one.
+    """
+
+    def __init__(self):
+        self.pending = b""
+
+    def feed(self, data):
+        """
+        Yields the data of the events completed by `data`. Multi-line data fields are joined
+        with newlines, other fields and comments are skipped.
+        """
+        if self.pending:
+            data = self.pending + data
+        view = memoryview(data)
+        event_start = pos = 0
+        lines = []
+        while True:
+            end = data.find(b"\n", pos)
+            if end == -1:
+                break
+            line_end = end - 1 if end > pos and data[end - 1] == 13 else end  # \r\n
+            if line_end == pos:
+                # a blank line dispatches the event
+                if lines:
+                    yield lines[0] if len(lines) == 1 else b"\n".join(lines)
+                    lines = []
+                event_start = end + 1
+            elif data.startswith(b"data:", pos):
+                value_start = pos + 5
+                if value_start < line_end and data[value_start] == 32:  # space
+                    value_start += 1
+                lines.append(view[value_start:line_end])
+            pos = end + 1
+        self.pending = data[event_start:]
+
+    def flush(self):
+        """Yields the data of the last event if the stream ended without a blank line."""
+        if self.pending:
+            yield from self.feed(b"\n\n")
+            self.pending = b""
+
+
+class ResponseAccumulator:
+    """
+    Collects the token counts of a single response, and its text if `keep_text` is set, from the
+    bytes received.
+    """
+
+    def __init__(self, provider_formatter, stream, prompt, prompt_usage_tokens, keep_text=False):
+        self.provider_formatter = provider_formatter
+        self.stream = stream
+        self.prompt = prompt
+        self.prompt_usage_tokens = prompt_usage_tokens
+        self.keep_text = keep_text
+        self.text_parts = []
+        self.num_chars = 0
+        self.done = False
+        self.total_usage_tokens = None
+        self.total_logprob_tokens = None
+        self.t_first_token = None
+        self.t_last_token = None
+        # seconds between consecutive reads that brought text
+        self.inter_token_latencies = array.array("d")
+        self.decoder = SSEDecoder() if stream else None
+        self.body_parts = []
+
+    def feed(self, data, now):
+        """
+        Processes bytes received at `now`, returns False if the rest of the response can be skipped.
+        """
+        if not data:
+            return True
+        if self.provider_formatter.parsed_options.embeddings:
+            self.t_first_token = now
+            return False
+        if not self.stream:
+            # parsed once complete
+            self.body_parts.append(data)
+            return True
+        for event in self.decoder.feed(data):
+            self.add_event(event, now)
+        return True
+
+    def finish(self, now):
+        """Processes the rest of the response once all of it is received at `now`."""
+        if self.stream:
+            for event in self.decoder.flush():
+                self.add_event(event, now)
+        elif self.body_parts:
+            self.add_event(b"".join(self.body_parts), now)
+            self.body_parts = []
+
+    def add_event(self, data, now):
+        if self.done:
+            if data != b"[DONE]":
+                print(f"WARNING: Received more events after [DONE]: {bytes(data)}")
+            return
+        if self.stream and data == b"[DONE]":
+            self.done = True
+            return
+        out = self.provider_formatter.parse_output_json(orjson.loads(data), self.prompt)
+        if out.usage_tokens:
+            self.total_usage_tokens = (self.total_usage_tokens or 0) + out.usage_tokens
+        if out.prompt_usage_tokens:
+            self.prompt_usage_tokens = out.prompt_usage_tokens
+        if out.text:
+            # some providers (SGLang) send an empty chunk first skewing the TTFT
+            if self.t_first_token is None:
+                self.t_first_token = now
+            elif now > self.t_last_token:
+                # events that came in the same read arrived together
+                self.inter_token_latencies.append(now - self.t_last_token)
+            self.t_last_token = now
+            self.num_chars += len(out.text)
+            if self.keep_text:
+                self.text_parts.append(out.text)
+
+        if out.logprob_tokens:
+            self.total_logprob_tokens = (
+                self.total_logprob_tokens or 0
+            ) + out.logprob_tokens
+
+    @property
+    def text(self):
+        assert self.keep_text, "the text of the response isn't kept"
+        return "".join(self.text_parts)
+
+    @property
+    def num_tokens(self):
+        if (
+            (self.total_logprob_tokens is not None)
+            and (self.total_usage_tokens is not None)
+            and self.total_logprob_tokens != self.total_usage_tokens
+        ):
+            print(
+                f"WARNING: usage_tokens {self.total_usage_tokens} != logprob_tokens {self.total_logprob_tokens}"
+            )
+        if self.total_logprob_tokens is not None:
+            return self.total_logprob_tokens
+        return self.total_usage_tokens or 0
+
+
+class RequestBundle:
+    """
+    Pre-serialized request bodies compiled offline by `compile_workload.py`.
+
+    Serializing long prompts with `json.dumps` on every request costs client CPU proportional to
+    the prompt size. A bundle stores ready-to-send bodies where every occurrence of `max_tokens`
+    (and its provider-specific aliases, like `min_tokens`) is cut out, so that sending a request
+    only requires joining the stored pieces with the sampled value.
+
+    File layout: magic, header length and JSON header, records, offsets of all records and
+    the offset of that index. Each record is the prompt token count, the number of pieces and
+    the length-prefixed pieces. The file is memory-mapped and shared by all users.
+    """
+
+    MAGIC = b"LLMBNDL1"
+    # Never produced by samplers, so any occurrence in the serialized body marks a max_tokens slot
+    MAX_TOKENS_PLACEHOLDER = 2147480001
+    # Options baked into the bodies, the test must use the same settings
+    BAKED_OPTIONS = [
+        "stream",
+        "chat",
+        "temperature",
+        "logprobs",
+        "top_k",
+        "n",
+        "prompt_cache_max_len",
+        "reasoning_effort",
+    ]
+
+    _instance = None
+    _RECORD_HEADER = struct.Struct("<IH")
+    _PIECE_HEADER = struct.Struct("<I")
+    _INDEX_POS = struct.Struct("<Q")
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        if self._mmap[: len(self.MAGIC)] != self.MAGIC:
+            raise ValueError(f"{path} is not a request bundle")
+        pos = len(self.MAGIC)
+        (header_len,) = self._PIECE_HEADER.unpack_from(self._mmap, pos)
+        pos += self._PIECE_HEADER.size
+        self.header = json.loads(self._mmap[pos : pos + header_len])
+        (index_pos,) = self._INDEX_POS.unpack_from(
+            self._mmap, len(self._mmap) - self._INDEX_POS.size
+        )
+        self._offsets = array.array("Q")
+        self._offsets.frombytes(
+            self._mmap[index_pos : len(self._mmap) - self._INDEX_POS.size]
+        )
+        self._pos = 0
+
+    @classmethod
+    def get_instance(cls, path: str):
+        if cls._instance is None:
+            cls._instance = cls(path)
+        else:
+            assert cls._instance.path == path
+        return cls._instance
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def next_body(self, max_tokens: int):
+        """
+        Returns the next request body with `max_tokens` filled in, its prompt token count and the
+        index of the record.
+        """
+        record_id = self._pos
+        offset = self._offsets[self._pos]
+        self._pos = (self._pos + 1) % len(self._offsets)
+        prompt_tokens, num_pieces = self._RECORD_HEADER.unpack_from(self._mmap, offset)
+        offset += self._RECORD_HEADER.size
+        value = str(max_tokens).encode()
+        pieces = []
+        for i in range(num_pieces):
+            (length,) = self._PIECE_HEADER.unpack_from(self._mmap, offset)
+            offset += self._PIECE_HEADER.size
+            if i > 0:
+                pieces.append(value)
+            pieces.append(self._view[offset : offset + length])
+            offset += length
+        return b"".join(pieces), prompt_tokens, record_id
+
+    @classmethod
+    def _count_placeholders(cls, data):
+        if isinstance(data, dict):
+            return sum(cls._count_placeholders(v) for v in data.values())
+        if isinstance(data, list):
+            return sum(cls._count_placeholders(v) for v in data)
+        return int(data == cls.MAX_TOKENS_PLACEHOLDER and not isinstance(data, bool))
+
+    @classmethod
+    def compile(
+        cls, path: str, provider: str, provider_formatter, dataset, num_records: int
+    ):
+        """Serializes `num_records` requests from `dataset` into a bundle at `path`."""
+        placeholder = str(cls.MAX_TOKENS_PLACEHOLDER).encode()
+        header = {
+            "provider": provider,
+            "model": provider_formatter.model,
+            "url": provider_formatter.get_url(),
+            "num_records": num_records,
+        }
+        for key in cls.BAKED_OPTIONS:
+            header[key] = getattr(provider_formatter.parsed_options, key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        offsets = array.array("Q")
+        with open(tmp_path, "wb") as f:
+            header_bytes = json.dumps(header).encode()
+            f.write(cls.MAGIC)
+            f.write(cls._PIECE_HEADER.pack(len(header_bytes)))
+            f.write(header_bytes)
+            for i in range(num_records):
+                prompt, prompt_tokens, *_ = next(dataset)
+                data = provider_formatter.format_payload(
+                    prompt, cls.MAX_TOKENS_PLACEHOLDER, None
+                )
+                pieces = orjson.dumps(data).split(placeholder)
+                if len(pieces) - 1 != cls._count_placeholders(data):
+                    raise ValueError(
+                        f"Record {i} contains the max_tokens placeholder {cls.MAX_TOKENS_PLACEHOLDER} in its content"
+                    )
+                offsets.append(f.tell())
+                f.write(cls._RECORD_HEADER.pack(prompt_tokens or 0, len(pieces)))
+                for piece in pieces:
+                    f.write(cls._PIECE_HEADER.pack(len(piece)))
+                    f.write(piece)
+                if (i + 1) % 1000 == 0:
+                    print(f"  Compiled {i + 1}/{num_records} requests...")
+            index_pos = f.tell()
+            offsets.tofile(f)
+            f.write(cls._INDEX_POS.pack(index_pos))
+        os.replace(tmp_path, path)
+
+
 def _load_curl_like_data(text):
     """
     Either use the passed string or load from a file if the string is `@filename`
@@ -667,20 +2612,135 @@ def _load_curl_like_data(text):
         return text
 
 
-class LLMUser(HttpUser):
-    # no wait time, so every user creates a continuous load, sending requests as quickly as possible
+class TimedConnectionMixin:
+    """
+    Records when the phases of a request happen on an urllib3 connection: DNS resolution, TCP and
+    TLS handshakes (only for the request that opened the connection), sending of the request and
+    receiving of the response headers. Timestamps are `time.perf_counter()` values.
+    """
 
-    def on_start(self):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.phases = {}
+        self.reused = False
+
+    def _new_conn(self):
+        # resolve separately to tell DNS from the TCP handshake, trying addresses in order
+        host = self._dns_host
+        self.phases["connect_start"] = time.perf_counter()
         try:
-            self._on_start()
-        except Exception as e:
-            print(f"Failed to initialize: {repr(e)}")
-            print(traceback.format_exc())
-            sys.exit(1)
+            addresses = [
+                info[4][0]
+                for info in socket.getaddrinfo(host, self.port, 0, socket.SOCK_STREAM)
+            ]
+        except socket.gaierror:
+            # let urllib3 report the error
+            addresses = [host]
+        self.phases["dns_end"] = time.perf_counter()
+        try:
+            for i, address in enumerate(addresses):
+                self._dns_host = address
+                try:
+                    sock = super()._new_conn()
+                    break
+                except NewConnectionError:
+                    if i == len(addresses) - 1:
+                        raise
+        finally:
+            self._dns_host = host
+        self.phases["tcp_end"] = time.perf_counter()
+        return sock
 
-    def _guess_provider(self):
-        self.model = self.environment.parsed_options.model
-        self.provider = self.environment.parsed_options.provider
+    def connect(self):
+        self.reused = False
+        super().connect()
+        self.phases["connect_end"] = time.perf_counter()
+        if isinstance(self, HTTPSConnection):
+            self.phases["tls_end"] = self.phases["connect_end"]
+
+    def request(self, *args, **kwargs):
+        if self.reused:
+            self.phases = {}
+        self.phases["request_start"] = time.perf_counter()
+        super().request(*args, **kwargs)
+        self.phases["request_sent"] = time.perf_counter()
+
+    def getresponse(self, *args, **kwargs):
+        response = super().getresponse(*args, **kwargs)
+        self.phases["headers_received"] = time.perf_counter()
+        self.reused = True
+        return response
+
+
+class TimedHTTPConnection(TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(TimedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """
+    Requests adapter whose connections record the timings of request phases.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": TimedHTTPConnectionPool,
+            "https": TimedHTTPSConnectionPool,
+        }
+
+
+def report_request_phases(t_start, phases):
+    """
+    Emits the durations of the phases recorded by TimedConnectionMixin for a request started at
+    `t_start`.
+    """
+    if "tcp_end" in phases:
+        add_custom_metric("connect_dns", (phases["dns_end"] - phases["connect_start"]) * 1000)
+        add_custom_metric("connect_tcp", (phases["tcp_end"] - phases["dns_end"]) * 1000)
+        if "tls_end" in phases:
+            add_custom_metric("connect_tls", (phases["tls_end"] - phases["tcp_end"]) * 1000)
+    if "request_sent" in phases:
+        # HTTP connections connect inside of the request
+        upload_start = max(phases["request_start"], phases.get("connect_end", 0))
+        add_custom_metric("request_upload", (phases["request_sent"] - upload_start) * 1000)
+    if "headers_received" in phases:
+        add_custom_metric("time_to_first_byte", (phases["headers_received"] - t_start) * 1000)
+
+
+class LLMUser(HttpUser):
+    # ids of multi-turn conversations, unique across users of the process
+    _conversation_ids = itertools.count(1)
+    # order of the users of the process, seeds their length samplers
+    _user_ids = itertools.count()
+    # no wait time, so every user creates a continuous load, sending requests as quickly as possible
+
+    def on_start(self):
+        try:
+            self._on_start()
+        except Exception as e:
+            print(f"Failed to initialize: {repr(e)}")
+            print(traceback.format_exc())
+            sys.exit(1)
+
+    def _guess_provider(self):
+        self.model = self.environment.parsed_options.model
+        self.provider = self.environment.parsed_options.provider
+        if self.request_bundle is not None:
+            # the bundle was compiled for a specific provider and model
+            self.model = self.model or self.request_bundle.header["model"]
+            self.provider = self.provider or self.request_bundle.header["provider"]
         # guess based on URL
         if self.provider is None:
             if "fireworks.ai" in self.host:
@@ -733,6 +2793,11 @@ class LLMUser(HttpUser):
 
     def _on_start(self):
         self.client.headers["Content-Type"] = "application/json"
+        if not self.environment.parsed_options.keep_alive:
+            self.client.headers["Connection"] = "close"
+        adapter = TimedHTTPAdapter(pool_maxsize=self._connection_pool_size() or 10)
+        self.client.mount("http://", adapter)
+        self.client.mount("https://", adapter)
         if self.environment.parsed_options.api_key:
             self.client.headers["Authorization"] = (
                 "Bearer " + self.environment.parsed_options.api_key
@@ -741,11 +2806,29 @@ class LLMUser(HttpUser):
             for header in self.environment.parsed_options.header:
                 key, val = header.split(":", 1)
                 self.client.headers[key] = val
+        self.request_bundle = None
+        if self.environment.parsed_options.request_bundle:
+            self.request_bundle = RequestBundle.get_instance(
+                self.environment.parsed_options.request_bundle
+            )
         self._guess_provider()
         print(f" Provider {self.provider} using model {self.model} ".center(80, "*"))
         self.provider_formatter = PROVIDER_CLASS_MAP[self.provider](
             self.model, self.environment.parsed_options
         )
+        if self.request_bundle is not None:
+            expected = {
+                "provider": self.provider,
+                "model": self.model,
+                "url": self.provider_formatter.get_url(),
+            }
+            for key in RequestBundle.BAKED_OPTIONS:
+                expected[key] = getattr(self.environment.parsed_options, key)
+            for key, value in expected.items():
+                if self.request_bundle.header.get(key) != value:
+                    raise ValueError(
+                        f"Request bundle was compiled for {key}={self.request_bundle.header.get(key)}, but the test uses {value}"
+                    )
 
         self.stream = self.environment.parsed_options.stream
 
@@ -754,6 +2837,10 @@ class LLMUser(HttpUser):
         )
         self.prompt_images = None
         if image_resolutions:
+            if self.request_bundle is not None:
+                raise AssertionError(
+                    "--prompt-images-with-resolutions can't be combined with --request-bundle."
+                )
             if not self.environment.parsed_options.chat:
                 # Using regular /completions endpoint, each model has it's own image placeholder
                 # e.g., <|image|> for Phi, <|image_pad|> for Qwen, <image> for Llava
@@ -761,17 +2848,44 @@ class LLMUser(HttpUser):
                 raise AssertionError(
                     "--prompt-images-with-resolutions is only supported with --chat mode."
                 )
-            self.prompt_images = [
-                self._create_base64_image(width, height)
-                for width, height in image_resolutions
-            ]
+            self.prompt_images = ImagePool.get_instance(
+                self.environment.parsed_options
+            )
 
+        seed = self.environment.parsed_options.prompt_pool_seed
+        if seed is not None:
+            # every user (and worker) draws its own reproducible sequence
+            seed = [seed, InitTracker.worker_rank, next(LLMUser._user_ids)]
         self.max_tokens_sampler = LengthSampler(
             distribution=self.environment.parsed_options.max_tokens_distribution,
             mean=self.environment.parsed_options.max_tokens,
             cap=self.environment.parsed_options.max_tokens_cap,
             alpha=self.environment.parsed_options.max_tokens_range,
+            seed=seed,
         )
+        self.prompt_tokens_sampler = None
+        if self.environment.parsed_options.prompt_tokens_distribution != "constant":
+            self.prompt_tokens_sampler = LengthSampler(
+                distribution=self.environment.parsed_options.prompt_tokens_distribution,
+                mean=self.environment.parsed_options.prompt_tokens,
+                cap=self.environment.parsed_options.prompt_tokens_cap,
+                alpha=self.environment.parsed_options.prompt_tokens_range,
+                # the output lengths use the same seed, keep the sequences apart
+                seed=None if seed is None else seed + [1],
+            )
+        self.length_sampler = None
+        if self.environment.parsed_options.length_distribution_file:
+            self.length_sampler = JointLengthSampler(
+                self.environment.parsed_options.length_distribution_file,
+                independent=self.environment.parsed_options.length_distribution_independent,
+                seed=seed,
+            )
+        if self.request_bundle is not None and (
+            self.prompt_tokens_sampler is not None or self.length_sampler is not None
+        ):
+            raise ValueError(
+                "Prompt length distributions can't be combined with --request-bundle"
+            )
         self.temperature = self.environment.parsed_options.temperature
         self.prompt_tokenizer_tokens = None
 
@@ -779,8 +2893,12 @@ class LLMUser(HttpUser):
             # TODO: add some server info with git version
             "provider": self.provider,
             "model": self.model,
-            "prompt_tokens": self.environment.parsed_options.prompt_tokens,  # might be overwritten based on metric
-            "generation_tokens": str(self.max_tokens_sampler),
+            "prompt_tokens": str(
+                self.length_sampler
+                or self.prompt_tokens_sampler
+                or self.environment.parsed_options.prompt_tokens
+            ),  # might be overwritten based on metric
+            "generation_tokens": str(self.length_sampler or self.max_tokens_sampler),
             "stream": self.stream,
             "temperature": self.temperature,
             "logprobs": self.environment.parsed_options.logprobs,
@@ -791,16 +2909,77 @@ class LLMUser(HttpUser):
 
         InitTracker.notify_init(self.environment, logging_params)
 
-        if self.environment.parsed_options.qps is not None:
+        self._init_pacing()
+
+        self.conversation = None
+        if self.environment.parsed_options.conversation_turns:
+            self._init_conversation()
+
+        self.first_done = False
+
+        if self.request_bundle is None:
+            dataset = DatasetHolder.get_instance(self.environment.parsed_options)
+            self.dataset = iter(dataset)
+            variable_length = (
+                self.trace_replayer is not None
+                or self.prompt_tokens_sampler is not None
+                or self.length_sampler is not None
+            )
+            if variable_length and not hasattr(self.dataset, "sample"):
+                raise ValueError(
+                    "--trace and prompt length distributions require a dataset that can generate prompts of any length, e.g. 'limerics' without --prompt-pool-size"
+                )
+
+    def _connection_pool_size(self):
+        """Returns the maximum number of idle connections kept by a user, None for the default."""
+        options = self.environment.parsed_options
+        if options.connection_pool_size is not None:
+            return options.connection_pool_size
+        if options.open_loop or options.trace:
+            # requests are sent concurrently by a single user, connections above the size of the
+            # pool would be closed after every request
+            return options.max_in_flight
+        return None
+
+    def _init_pacing(self):
+        self.trace_replayer = None
+        self.open_loop_pacer = None
+        if self.environment.parsed_options.open_loop and (
+            self.environment.parsed_options.qps is None
+            or self.environment.parsed_options.conversation_turns
+        ):
+            raise ValueError(
+                "--open-loop requires --qps and can't be combined with --conversation-turns"
+            )
+        if self.environment.parsed_options.trace:
+            if (
+                self.environment.parsed_options.qps is not None
+                or self.environment.parsed_options.burst
+                or self.environment.parsed_options.conversation_turns
+                or self.request_bundle is not None
+            ):
+                raise ValueError(
+                    "--trace can't be combined with --qps, --burst, --conversation-turns or --request-bundle"
+                )
+            self.trace_replayer = TraceReplayer.instance(
+                self.environment.parsed_options.trace,
+                self.environment.parsed_options.trace_speedup,
+            )
+        elif self.environment.parsed_options.qps is not None:
             if self.environment.parsed_options.burst:
                 raise ValueError("Burst and QPS modes are mutually exclusive")
             pacer = FixedQPSPacer.instance(
                 self.environment.parsed_options.qps,
                 self.environment.parsed_options.qps_distribution,
             )
-            # it will be called by Locust after each task
-            self.wait_time = pacer.wait_time_till_next
-            self.wait()
+            if self.environment.parsed_options.open_loop:
+                # requests are dispatched in the background at the scheduled times
+                self.open_loop_pacer = pacer
+                self.open_loop_requests = gevent.pool.Group()
+            else:
+                # it will be called by Locust after each task
+                self.wait_time = pacer.wait
+                self.wait()
         elif self.environment.parsed_options.burst:
             self.wait_time = partial(
                 constant_pacing(self.environment.parsed_options.burst), self
@@ -809,24 +2988,78 @@ class LLMUser(HttpUser):
             # introduce initial delay to avoid all users hitting the service at the same time
             time.sleep(random.random())
 
-        self.first_done = False
+    def _init_conversation(self):
+        options = self.environment.parsed_options
+        if not options.chat or options.embeddings:
+            raise ValueError("--conversation-turns is only supported with --chat mode")
+        if self.request_bundle is not None or self.prompt_images:
+            raise ValueError(
+                "--conversation-turns can't be combined with --request-bundle or images"
+            )
+        self.conversation = []
+        self.conversation_id = None
+        self.conversation_turns_left = 0
+        self.conversation_tokens = 0
+        if options.conversation_think_time:
+            if options.qps is not None or options.burst:
+                raise ValueError(
+                    "--conversation-think-time can't be combined with --qps or --burst"
+                )
+            # it will be called by Locust after each task
+            self.wait_time = self._conversation_think_time
 
-        dataset = DatasetHolder.get_instance(self.environment.parsed_options)
-        self.dataset = iter(dataset)
+    def _conversation_think_time(self):
+        if self.conversation_turns_left == 0:
+            # the next request starts a new conversation
+            return 0
+        return random.uniform(*self._range(self.environment.parsed_options.conversation_think_time))
 
-    def _create_base64_image(self, width, height):
-        """Create a random RGB image with the given dimensions and return as base64 data URI."""
-        img = Image.new("RGB", (width, height))
-        buffer = io.BytesIO()
-        img.save(buffer, format="JPEG")
-        img_str = base64.b64encode(buffer.getvalue()).decode("utf-8")
-        return f"data:image/jpeg;base64,{img_str}"
+    @staticmethod
+    def _range(values):
+        return values[0], values[-1]
 
-    def _get_input(self):
-        prompt, prompt_tokens = next(self.dataset)
+    def _add_conversation_turn(self, prompt, prompt_tokens, tags):
+        """
+        Appends the new user turn to the conversation of this user, returns the prompt with
+        the whole history and an estimate of its length.
+        """
+        if not isinstance(prompt, str):
+            raise ValueError("--conversation-turns requires a dataset of plain text prompts")
+        # the previous turn didn't get a response, start over
+        if self.conversation and self.conversation[-1]["role"] == "user":
+            self.conversation_turns_left = 0
+        if self.conversation_turns_left == 0:
+            self.conversation = []
+            self.conversation_id = next(LLMUser._conversation_ids)
+            self.conversation_turns_left = random.randint(
+                *self._range(self.environment.parsed_options.conversation_turns)
+            )
+            self.conversation_tokens = 0
+        self.conversation.append({"role": "user", "content": prompt})
+        self.conversation_turns_left -= 1
+        self.conversation_tokens += prompt_tokens or 0
+        tags["conversation_id"] = self.conversation_id
+        tags["conversation_turn"] = (len(self.conversation) + 1) // 2
+        return {"messages": self.conversation}, self.conversation_tokens
+
+    def _finish_conversation_turn(self, text, num_tokens, max_tokens):
+        self.conversation.append({"role": "assistant", "content": text})
+        if not num_tokens:
+            # the provider reported no usage, estimate the length of the text
+            count_tokens = getattr(self.dataset, "count_tokens", None)
+            num_tokens = count_tokens(text) if count_tokens is not None else max_tokens
+        self.conversation_tokens += num_tokens
+
+    def _get_input(self, num_tokens=None):
+        # datasets may return a dict of tags describing the sample as the third element
+        if num_tokens is None:
+            prompt, prompt_tokens, *tags = next(self.dataset)
+        else:
+            prompt, prompt_tokens, *tags = self.dataset.sample(num_tokens)
+        tags = tags[0] if tags else {}
 
         if self.prompt_images:
-            images = self.prompt_images
+            images = self.prompt_images.sample()
             prompt_images_positioning = (
                 self.environment.parsed_options.prompt_images_positioning
             )
@@ -836,7 +3069,7 @@ class LLMUser(HttpUser):
         else:
             images = None
 
-        return prompt, prompt_tokens, images
+        return prompt, prompt_tokens, images, tags
 
     def insert_image_placeholders(self, prompt, num_images, prompt_images_positioning):
         if num_images <= 0:
@@ -881,122 +3114,359 @@ class LLMUser(HttpUser):
 
     @task
     def generate_text(self):
-        max_tokens = self.max_tokens_sampler.sample()
-        prompt, prompt_usage_tokens, images = self._get_input()
-        data = self.provider_formatter.format_payload(prompt, max_tokens, images)
-        t_start = time.perf_counter()
+        if self.trace_replayer is not None:
+            self._dispatch_trace_request()
+            return
+        if self.open_loop_pacer is not None:
+            self._dispatch_open_loop_request()
+            return
+        with ClientMonitor.track_request():
+            self._send_request(*self._next_request())
 
-        with self.client.post(
-            self.provider_formatter.get_url(),
-            data=json.dumps(data),
-            stream=True,
-            catch_response=True,
-        ) as response:
-            combined_text = ""
-            done = False
-            total_usage_tokens = None
-            total_logprob_tokens = None
-            try:
-                response.raise_for_status()
-            except Exception as e:
-                raise RuntimeError(f"Error in response: {response.text}") from e
-            t_first_token = None
-            for chunk in response.iter_lines(delimiter=b"\n\n"):
-                if len(chunk) == 0:
-                    continue  # come providers send empty lines between data chunks
-                if done:
-                    if chunk != b"data: [DONE]":
-                        print(f"WARNING: Received more chunks after [DONE]: {chunk}")
+    def _next_request(self):
+        """
+        Samples the next request, returns the arguments of `_send_request`.
+        """
+        if self.length_sampler is not None:
+            prompt_tokens, max_tokens = self.length_sampler.sample()
+        else:
+            max_tokens = self.max_tokens_sampler.sample()
+            prompt_tokens = None
+            if self.prompt_tokens_sampler is not None:
+                prompt_tokens = self.prompt_tokens_sampler.sample()
+        if self.request_bundle is not None:
+            body, prompt_usage_tokens, record_id = self.request_bundle.next_body(max_tokens)
+            prompt = None
+            tags = {"record_id": record_id}
+        else:
+            prompt, prompt_usage_tokens, images, tags = self._get_input(prompt_tokens)
+            if self.conversation is not None:
+                prompt, prompt_usage_tokens = self._add_conversation_turn(
+                    prompt, prompt_usage_tokens, tags
+                )
+            data = self.provider_formatter.format_payload(prompt, max_tokens, images)
+            body = json.dumps(data)
+        return body, max_tokens, prompt, prompt_usage_tokens, tags
+
+    def _dispatch_trace_request(self):
+        """
+        Issues the next request of the trace at its recorded time without waiting for the response,
+        so the arrival rate doesn't depend on the latency of the server or the number of users.
+        """
+        if InitTracker.users is None:
+            # start the trace once all users are spawned, Locust may reset stats at that point
+            time.sleep(0.1)
+            return
+        entry = self.trace_replayer.next_entry()
+        if entry is None:
+            # other users may still be waiting to issue the last requests
+            while self.trace_replayer.dispatched < len(self.trace_replayer):
+                time.sleep(0.1)
+            print("Trace replay finished, waiting for in-flight requests")
+            self.trace_replayer.in_flight.join()
+            if isinstance(self.environment.runner, WorkerRunner):
+                InitTracker.notify_trace_finished()
+                raise StopUser()
+            self.environment.runner.quit()
+            return
+        delay = entry.time - time.time()
+        add_custom_metric("arrival_lateness", max(0, -delay) * 1000)
+        if delay > 0:
+            time.sleep(delay)
+        if self._drop_arrival():
+            self.trace_replayer.dispatched += 1
+            return
+        prompt, prompt_usage_tokens, images, tags = self._get_input(entry.input_tokens)
+        data = self.provider_formatter.format_payload(
+            prompt, entry.output_tokens, images
+        )
+        if entry.model is not None:
+            data["model"] = entry.model
+            tags["model"] = entry.model
+        if entry.priority is not None:
+            data["priority"] = entry.priority
+        self.trace_replayer.in_flight.spawn(
+            self._send_request_in_background,
+            json.dumps(data),
+            entry.output_tokens,
+            prompt,
+            prompt_usage_tokens,
+            tags,
+        )
+        self.trace_replayer.dispatched += 1
+
+    def _dispatch_open_loop_request(self):
+        """
+        Issues a request at every scheduled arrival without waiting for the responses, so when the
+        server slows down requests queue up instead of arrivals being delayed.
+        """
+        self.open_loop_pacer.wait()
+        if self._drop_arrival():
+            return
+        self.open_loop_requests.spawn(
+            self._send_request_in_background, *self._next_request()
+        )
+
+    def _drop_arrival(self):
+        """Returns True and counts the arrival as dropped if too many requests are in flight."""
+        if ClientMonitor.in_flight < self.environment.parsed_options.max_in_flight:
+            return False
+        # a counter: every sample is one dropped arrival, the count is reported
+        add_custom_metric("dropped_arrivals", 1)
+        return True
+
+    def on_stop(self):
+        if self.open_loop_pacer is not None:
+            self.open_loop_requests.kill(block=False)
+
+    def _send_request_in_background(self, *args):
+        # Locust only reports errors raised by tasks, so do it for spawned requests too
+        try:
+            with ClientMonitor.track_request():
+                self._send_request(*args)
+        except Exception as e:
+            print(f"Request failed: {repr(e)}")
+            self.environment.events.user_error.fire(
+                user_instance=self, exception=e, tb=e.__traceback__
+            )
+
+    def _send_request(self, body, max_tokens, prompt, prompt_usage_tokens, tags):
+        t_start = time.perf_counter()
+        ttft_deadline, total_deadline = self._sample_deadlines()
+        timeout = self._start_timeout(
+            ttft_deadline if ttft_deadline is not None else total_deadline
+        )
+        response = None
+        accumulator = None
+        try:
+            with self.client.post(
+                self.provider_formatter.get_url(),
+                data=body,
+                stream=True,
+                catch_response=True,
+            ) as response:
+                # the connection is released once the body is read
+                connection = getattr(response.raw, "connection", None)
+                if connection is not None and hasattr(connection, "phases"):
+                    report_request_phases(t_start, connection.phases)
                 try:
-                    now = time.perf_counter()
-                    if self.provider_formatter.parsed_options.embeddings:
-                        t_first_token = now
-                        break
-                    if self.stream:
-                        assert chunk.startswith(
-                            b"data:"
-                        ), f"Unexpected chunk not starting with 'data': {chunk}"
-                        chunk = chunk[len(b"data:") :]
-                        if chunk.strip() == b"[DONE]":
-                            done = True
-                            continue
-                    data = orjson.loads(chunk)
-                    out = self.provider_formatter.parse_output_json(data, prompt)
-                    if out.usage_tokens:
-                        total_usage_tokens = (
-                            total_usage_tokens or 0
-                        ) + out.usage_tokens
-                    if out.prompt_usage_tokens:
-                        prompt_usage_tokens = out.prompt_usage_tokens
-                    combined_text += out.text
-
-                    # some providers (SGLang) send an empty chunk first skewing the TTFT
-                    if combined_text and t_first_token is None:
-                        t_first_token = now
-
-                    if out.logprob_tokens:
-                        total_logprob_tokens = (
-                            total_logprob_tokens or 0
-                        ) + out.logprob_tokens
+                    response.raise_for_status()
                 except Exception as e:
-                    print(f"Failed to parse response: {chunk} with error {repr(e)}")
+                    raise RuntimeError(f"Error in response: {response.text}") from e
+                accumulator = self._new_accumulator(prompt, prompt_usage_tokens)
+                # unlike iter_lines, returns every chunk of the body as soon as it arrives
+                data = b""
+                try:
+                    for data in response.iter_content(chunk_size=None):
+                        if not accumulator.feed(data, time.perf_counter()):
+                            break
+                        if ttft_deadline is not None and accumulator.t_first_token is not None:
+                            # the first token came in time, only the total deadline is left
+                            ttft_deadline = None
+                            timeout.cancel()
+                            timeout = self._start_timeout(
+                                self._remaining(t_start, total_deadline)
+                            )
+                    data = b""
+                    accumulator.finish(time.perf_counter())
+                except Exception as e:
+                    print(f"Failed to parse response: {data} with error {repr(e)}")
                     response.failure(e)
+                    self._report_failure(t_start, accumulator, prompt_usage_tokens, tags)
                     return
-            assert t_first_token is not None, "empty response received"
-            if (
-                (total_logprob_tokens is not None)
-                and (total_usage_tokens is not None)
-                and total_logprob_tokens != total_usage_tokens
-            ):
-                print(
-                    f"WARNING: usage_tokens {total_usage_tokens} != logprob_tokens {total_logprob_tokens}"
-                )
-            if total_logprob_tokens is not None:
-                num_tokens = total_logprob_tokens
-            else:
-                num_tokens = total_usage_tokens
+                self._report_response(t_start, accumulator, max_tokens, tags)
+
+                if not self.first_done:
+                    self.first_done = True
+                    InitTracker.notify_first_request()
+        except gevent.Timeout as e:
+            if e is not timeout:
+                raise
+            # close the connection mid-stream like a client giving up, so the server can cancel
+            if response is not None:
+                response.close()
+            self._report_abandonment(t_start, accumulator, prompt_usage_tokens, tags)
+        except Exception:
+            self._report_failure(t_start, accumulator, prompt_usage_tokens, tags)
+            raise
+        finally:
+            if timeout is not None:
+                timeout.cancel()
+
+    def _sample_deadlines(self):
+        """Returns the deadlines in seconds for the first token and the whole request, or None."""
+        options = self.environment.parsed_options
+        return tuple(
+            None if mean is None else sample_duration(mean, options.deadline_distribution)
+            for mean in (options.ttft_deadline, options.total_deadline)
+        )
 
-            num_tokens = num_tokens or 0
-            num_chars = len(combined_text)
-            now = time.perf_counter()
-            dur_total = now - t_start
-            dur_generation = now - t_first_token
-            dur_first_token = t_first_token - t_start
-            print(
-                f"Response received: total {dur_total*1000:.2f} ms, first token {dur_first_token*1000:.2f} ms, {num_chars} chars, {num_tokens} tokens"
-            )
-            if self.environment.parsed_options.show_response:
-                print("---")
-                print(combined_text)
-                print("---")
-            if num_chars:
-                add_custom_metric(
-                    "latency_per_char", dur_generation / num_chars * 1000, num_chars
-                )
+    @staticmethod
+    def _remaining(t_start, deadline):
+        if deadline is None:
+            return None
+        return max(0, deadline - (time.perf_counter() - t_start))
+
+    @staticmethod
+    def _start_timeout(seconds):
+        if seconds is None:
+            return None
+        timeout = gevent.Timeout(seconds)
+        timeout.start()
+        return timeout
+
+    def _report_abandonment(self, t_start, accumulator, prompt_usage_tokens, tags):
+        """
+        Records a request given up on by the client. It's neither a failure nor a completed
+        request, the time until it was abandoned is reported by when it happened.
+        """
+        elapsed = (time.perf_counter() - t_start) * 1000
+        TimeSeriesRecorder.count("requests_abandoned")
+        self._log_request("abandoned", t_start, accumulator, prompt_usage_tokens, tags)
+        if accumulator is None or accumulator.t_first_token is None:
+            add_custom_metric("abandoned_before_first_token", elapsed)
+            print(f"Request abandoned before the first token after {elapsed:.2f} ms")
+        else:
+            add_custom_metric("abandoned_during_generation", elapsed)
+            print(f"Request abandoned during generation after {elapsed:.2f} ms")
+
+    def _report_failure(self, t_start, accumulator, prompt_usage_tokens, tags):
+        """Records a failed request, the exception itself is reported by the caller."""
+        TimeSeriesRecorder.count("requests_failed")
+        self._log_request("failed", t_start, accumulator, prompt_usage_tokens, tags)
+
+    def _log_request(self, status, t_start, accumulator, prompt_tokens, tags, num_tokens=None):
+        """Adds the request to the request log, if enabled."""
+        if not RequestLog.enabled:
+            return
+        t_first_token = None
+        if accumulator is not None:
+            prompt_tokens = accumulator.prompt_usage_tokens or prompt_tokens
             if self.stream:
-                add_custom_metric("time_to_first_token", dur_first_token * 1000)
-            add_custom_metric("total_latency", dur_total * 1000)
-            if num_tokens:
-                if num_tokens != max_tokens:
-                    print(
-                        f"WARNING: wrong number of tokens: {num_tokens}, expected {max_tokens}"
-                    )
-                add_custom_metric("num_tokens", num_tokens)
+                t_first_token = accumulator.t_first_token
+        # unknown counts are 0 or None
+        RequestLog.log(
+            status,
+            t_start,
+            t_first_token,
+            prompt_tokens or None,
+            num_tokens or None,
+            self.provider,
+            self.provider_formatter.model,
+            tags,
+        )
+
+    def _new_accumulator(self, prompt, prompt_usage_tokens):
+        return ResponseAccumulator(
+            self.provider_formatter,
+            self.stream,
+            prompt,
+            prompt_usage_tokens,
+            # the text is only needed to be printed, tokenized or continue the conversation
+            keep_text=self.environment.parsed_options.show_response
+            or self.environment.parsed_options.validate_output
+            or self.conversation is not None,
+        )
+
+    def _report_response(self, t_start, accumulator, max_tokens, tags):
+        """
+        Prints the response and emits its metrics once the last chunk is received.
+        """
+        assert accumulator.t_first_token is not None, "empty response received"
+        num_tokens = accumulator.num_tokens
+        num_chars = accumulator.num_chars
+        now = time.perf_counter()
+        dur_total = now - t_start
+        dur_generation = now - accumulator.t_first_token
+        dur_first_token = accumulator.t_first_token - t_start
+        if self.conversation is not None:
+            self._finish_conversation_turn(accumulator.text, num_tokens, max_tokens)
+        tags_info = ""
+        if "prefix_id" in tags:
+            cache_state = "hit" if tags["prefix_cache_hit"] else "miss"
+            tags_info += f", prefix {tags['prefix_id']} ({cache_state})"
+        if "conversation_id" in tags:
+            tags_info += f", conversation {tags['conversation_id']} turn {tags['conversation_turn']}"
+        inter_token_latencies = None
+        if accumulator.inter_token_latencies:
+            # decode stalls (batching, preemption, prefill interference) are hidden in the average
+            inter_token_latencies = np.frombuffer(accumulator.inter_token_latencies) * 1000
+            itl_p50, itl_p99 = np.percentile(inter_token_latencies, [50, 99])
+            itl_max = inter_token_latencies.max()
+            stalls = inter_token_latencies[
+                inter_token_latencies > self.environment.parsed_options.itl_stall_threshold
+            ]
+            add_custom_metric("itl_p50", itl_p50)
+            add_custom_metric("itl_p99", itl_p99)
+            add_custom_metric("itl_max", itl_max)
+            add_custom_metric_samples("inter_token_latency", inter_token_latencies)
+            add_custom_metric_samples("itl_stall", stalls)
+            tags_info += f", max ITL {itl_max:.2f} ms"
+            if len(stalls):
+                tags_info += f", {len(stalls)} stalls"
+        print(
+            f"Response received: total {dur_total*1000:.2f} ms, first token {dur_first_token*1000:.2f} ms, {num_chars} chars, {num_tokens} tokens{tags_info}"
+        )
+        if self.environment.parsed_options.show_response:
+            print("---")
+            print(accumulator.text)
+            print("---")
+        if num_chars:
+            add_custom_metric(
+                "latency_per_char", dur_generation / num_chars * 1000, num_chars
+            )
+        if self.stream:
+            add_custom_metric("time_to_first_token", dur_first_token * 1000)
+            if "prefix_id" in tags:
+                cache_state = "hit" if tags["prefix_cache_hit"] else "miss"
                 add_custom_metric(
-                    "latency_per_token", dur_generation / num_tokens * 1000, num_tokens
+                    f"time_to_first_token_prefix_{cache_state}",
+                    dur_first_token * 1000,
                 )
-                add_custom_metric(
-                    "overall_latency_per_token",
-                    dur_total / num_tokens * 1000,
-                    num_tokens,
+        add_custom_metric("total_latency", dur_total * 1000)
+        if num_tokens:
+            if num_tokens != max_tokens:
+                print(
+                    f"WARNING: wrong number of tokens: {num_tokens}, expected {max_tokens}"
                 )
-            prompt_tokens = prompt_usage_tokens or self.prompt_tokenizer_tokens
-            if prompt_tokens:
-                add_custom_metric("prompt_tokens", prompt_tokens)
+            add_custom_metric("num_tokens", num_tokens)
+            add_custom_metric(
+                "latency_per_token", dur_generation / num_tokens * 1000, num_tokens
+            )
+            add_custom_metric(
+                "overall_latency_per_token",
+                dur_total / num_tokens * 1000,
+                num_tokens,
+            )
+        prompt_tokens = accumulator.prompt_usage_tokens or self.prompt_tokenizer_tokens
+        if prompt_tokens:
+            add_custom_metric("prompt_tokens", prompt_tokens)
+        TimeSeriesRecorder.record_response(
+            num_tokens,
+            prompt_tokens,
+            dur_first_token * 1000 if self.stream else None,
+            inter_token_latencies,
+        )
+        self._log_request("completed", t_start, accumulator, prompt_tokens, tags, num_tokens)
+        if self.environment.parsed_options.validate_output:
+            OutputValidator.submit(
+                accumulator.text, num_tokens, max_tokens, dur_generation, dur_total
+            )
 
-            if not self.first_done:
-                self.first_done = True
-                InitTracker.notify_first_request()
+
+def parse_shard(shard_str):
+    """Parse a shard string like '2/8' into a tuple of integers (index, count)."""
+    try:
+        index, count = map(int, shard_str.split("/"))
+    except (ValueError, AttributeError):
+        raise argparse.ArgumentTypeError(
+            f"Invalid shard format: {shard_str}. Expected format: INDEX/COUNT (e.g. 0/4)"
+        )
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(
+            f"Invalid shard {shard_str}: index must be in range [0, {count})"
+        )
+    return (index, count)
 
 
 def parse_resolution(res_str):
@@ -1010,6 +3480,56 @@ def parse_resolution(res_str):
         )
 
 
+def parse_resolutions(res_str):
+    """Parse alternative resolutions like '1024x1024,512x512' into a list of (width, height) tuples."""
+    return [parse_resolution(res) for res in res_str.split(",")]
+
+
+def run_processes(options):
+    """
+    Runs the test in distributed mode on this host: a master with the same arguments and
+    `--processes` workers, so load generation isn't limited by a single core. Returns the exit
+    code of the master, which merges the stats of the workers and writes the reports.
+    """
+    num_processes = options.processes if options.processes > 0 else os.cpu_count()
+    # build the dataset once: workers pick up the token counts, cached samples and JSONL indices
+    # from .dataset_cache and share the mmap-ed files through the page cache
+    if not options.request_bundle:
+        DatasetHolder.get_instance(options)
+    if options.prompt_images_with_resolutions:
+        ImagePool.get_instance(options)
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = str(s.getsockname()[1])
+    locust_cmd = [sys.executable, "-m", "locust"]
+    print(f"Starting a master and {num_processes} worker processes on port {port}")
+    master = subprocess.Popen(
+        locust_cmd
+        + sys.argv[1:]
+        + ["--master", "--master-bind-host", "127.0.0.1", "--master-bind-port", port]
+        + ["--expect-workers", str(num_processes)]
+    )
+    workers = [
+        subprocess.Popen(
+            locust_cmd
+            + ["-f", os.path.abspath(__file__), "--worker", "--master-port", port]
+            # workers pick the user class before they get the rest of the options
+            + ["--engine", options.engine]
+        )
+        for _ in range(num_processes)
+    ]
+    try:
+        exit_code = master.wait()
+        for worker in workers:
+            worker.wait(timeout=60)
+    finally:
+        for process in [master] + workers:
+            if process.poll() is None:
+                process.kill()
+    return exit_code
+
+
 @events.init_command_line_parser.add_listener
 def init_parser(parser):
     parser.add_argument(
@@ -1026,6 +3546,45 @@ def init_parser(parser):
         help="Either 'limerics' or a path to a JSONL file",
         default="limerics",
     )
+    parser.add_argument(
+        "--dataset-shuffle",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="For JSONL datasets: visit records in a random order, reshuffled on every pass over the file",
+    )
+    parser.add_argument(
+        "--dataset-shard",
+        type=parse_shard,
+        default=None,
+        help="For JSONL datasets: only use the subset of records INDEX/COUNT (every COUNT-th record starting at INDEX). Use it to give disjoint parts of the file to different load generator processes",
+    )
+    parser.add_argument(
+        "--request-bundle",
+        env_var="REQUEST_BUNDLE",
+        type=str,
+        default=None,
+        help="Path to a bundle of pre-serialized request bodies produced by compile_workload.py. Replaces --dataset, only max_tokens is filled in per request",
+    )
+    parser.add_argument(
+        "--dataset-cache-samples",
+        env_var="DATASET_CACHE_SAMPLES",
+        type=int,
+        default=0,
+        help="With 'limerics' dataset and --tokenizer: pre-generate the specified number of prompts trimmed to exactly --prompt-tokens tokens into a JSONL file in .dataset_cache (reused by later runs) and replay it. Defaults to 0 (generate prompts on the fly)",
+    )
+    parser.add_argument(
+        "--prompt-pool-size",
+        env_var="PROMPT_POOL_SIZE",
+        type=int,
+        default=0,
+        help="Pre-generate a pool of the specified number of prompts at startup and pick from it at random on each request, instead of building every prompt on the fly. Only applies to the 'limerics' dataset. Defaults to 0 (no pool)",
+    )
+    parser.add_argument(
+        "--prompt-pool-seed",
+        type=int,
+        default=None,
+        help="Random seed used to generate prompts (and the prompt pool) and images, to pick them on every request and to sample prompt and output lengths. Makes the workload reproducible across runs",
+    )
     parser.add_argument(
         "-m",
         "--model",
@@ -1037,7 +3596,26 @@ def init_parser(parser):
         "--tokenizer",
         env_var="TOKENIZER",
         type=str,
-        help="Specify HF tokenizer to use for validating the output of the model. It's optional, we're going to rely on 'usage' or 'logprobs' field to get token count information",
+        help="Specify HF tokenizer to use for building exact-length prompts and, with --validate-output, for validating the output of the model. It's optional, we're going to rely on 'usage' or 'logprobs' field to get token count information",
+    )
+    parser.add_argument(
+        "--tokenizer-revision",
+        env_var="TOKENIZER_REVISION",
+        type=str,
+        default=None,
+        help="Revision (branch, tag or commit) of the HF tokenizer specified with --tokenizer",
+    )
+    parser.add_argument(
+        "--metrics-as-requests",
+        action="store_true",
+        default=False,
+        help="Also report metrics (time to first token, tokens, ...) as fake Locust requests of type METRIC, like before they had histograms of their own. Needed to see them in Locust's web UI, --csv-full-history and Grafana, at the cost of coarser percentiles there and some client CPU",
+    )
+    parser.add_argument(
+        "--validate-output",
+        action="store_true",
+        default=False,
+        help="Count the tokens of every response with --tokenizer in a background thread, outside of the measured latencies. Reports 'tokenizer_num_tokens', the 'tokenizer_mismatch' with the count reported by the provider and the 'max_tokens_mismatch'. Provides the token count metrics for providers that return neither usage nor logprobs",
     )
     parser.add_argument(
         "--chat",
@@ -1059,17 +3637,59 @@ def init_parser(parser):
         default=512,
         help="Length of the prompt in tokens. Default 512",
     )
+    parser.add_argument(
+        "--prompt-tokens-distribution",
+        env_var="PROMPT_TOKENS_DISTRIBUTION",
+        type=str,
+        choices=["constant", "uniform", "exponential", "normal"],
+        default="constant",
+        help="How to sample the prompt length on each request, --prompt-tokens is the mean. Works like --max-tokens-distribution. Requires a dataset that generates prompts, e.g. 'limerics'",
+    )
+    parser.add_argument(
+        "--prompt-tokens-range",
+        env_var="PROMPT_TOKENS_RANGE",
+        type=float,
+        default=0.3,
+        help="Width of --prompt-tokens-distribution relative to --prompt-tokens, like --max-tokens-range. Defaults to 0.3",
+    )
+    parser.add_argument(
+        "--prompt-tokens-cap",
+        env_var="PROMPT_TOKENS_CAP",
+        type=int,
+        help="If --prompt-tokens-distribution is non-constant, this truncates the distribution at the specified limit",
+    )
+    parser.add_argument(
+        "--length-distribution-file",
+        type=str,
+        default=None,
+        help="CSV or JSONL file with 'prompt_tokens', 'output_tokens' and optional 'weight' fields (e.g. a histogram of production traffic). "
+        "Prompt and output lengths of each request are sampled from it jointly, overriding the --prompt-tokens and --max-tokens distributions",
+    )
+    parser.add_argument(
+        "--length-distribution-independent",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Must be used with --length-distribution-file. Sample prompt and output lengths independently from their marginal distributions",
+    )
     parser.add_argument(
         "--prompt-images-with-resolutions",
-        type=parse_resolution,
+        type=parse_resolutions,
         nargs="+",
         default=[],
         help="Images to add to the prompt for vision models, defined by their resolutions in format WIDTHxHEIGHT. "
         'For example, "--prompt-images-with-resolutions 3084x1080 1024x1024" will insert 2 images '
         "(3084 width x 1080 height and 1024 width x 1024 height) into the prompt. "
+        'Comma-separated alternatives pick a resolution at random on every request, e.g. "512x512,1024x1024". '
         "Images will be spaced out evenly across the prompt."
         "Only supported with --chat mode.",
     )
+    parser.add_argument(
+        "--prompt-images-pool-size",
+        type=int,
+        default=16,
+        help="Number of distinct random images generated for every resolution in --prompt-images-with-resolutions. "
+        "Each request picks images from the pool at random. Defaults to 16",
+    )
     parser.add_argument(
         "--prompt-images-positioning",
         type=str,
@@ -1145,7 +3765,25 @@ def init_parser(parser):
     parser.add_argument(
         "--summary-file",
         type=str,
-        help="Append the line with the summary to the specified CSV file. Useful for generating a spreadsheet with perf sweep results. If the file doesn't exist, writes out the header first",
+        help="Append the line with the summary to the specified CSV file. Useful for generating a spreadsheet with perf sweep results. If the file doesn't exist, writes out the header first. Runs with options that add columns rewrite the file with the new columns",
+    )
+    parser.add_argument(
+        "--timeseries-file",
+        type=str,
+        default=None,
+        help="Write per-second requests started/completed/failed/abandoned, output and prompt tokens, requests in flight and rolling TTFT and inter-token latency percentiles to this Parquet file (Arrow IPC if it ends with .arrow). Covers the whole test including the warm-up. Requires pyarrow",
+    )
+    parser.add_argument(
+        "--timeseries-window",
+        type=int,
+        default=10,
+        help="Number of seconds the percentiles of --timeseries-file are computed over. Defaults to 10",
+    )
+    parser.add_argument(
+        "--request-log",
+        type=str,
+        default=None,
+        help="Write a record of every request (start and end time, TTFT, prompt and output tokens, status, provider, model, dataset record id, load shape phase and whether it's warm-up) to this Parquet file (Arrow IPC if it ends with .arrow). In distributed mode every worker writes its own file with a .workerN suffix. Requires pyarrow",
     )
     parser.add_argument(
         "--qps",
@@ -1160,12 +3798,85 @@ def init_parser(parser):
         default="constant",
         help="Must be used with --qps. Specifies how to space out requests: equally ('constant') or by sampling wait times from a distribution ('uniform' or 'exponential'). Expected QPS is going to match --qps",
     )
+    parser.add_argument(
+        "--open-loop",
+        action="store_true",
+        default=False,
+        help="Must be used with --qps. Issue every request at its scheduled time without waiting for the previous responses, so an overloaded server builds up a queue instead of slowing down arrivals. A single user is enough",
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=1000,
+        help="Maximum number of requests in flight per process with --open-loop and --trace. Arrivals above the limit are dropped and counted in the 'dropped_arrivals' metric",
+    )
+    parser.add_argument(
+        "--load-shape",
+        choices=["step", "ramp", "sine"],
+        default=None,
+        help="Runs a sweep over --load-shape-levels in a single test, one phase per level. The levels are concurrencies, or QPS values if --qps is set (its value is then ignored). 'step' switches to the next level at once, 'ramp' moves to it linearly over the warm-up and 'sine' oscillates around it. Stats are reset after the warm-up of every phase and summarized when it ends",
+    )
+    parser.add_argument(
+        "--load-shape-levels",
+        type=float,
+        nargs="+",
+        default=None,
+        help="Must be used with --load-shape. Concurrency or QPS levels to step through, e.g. 1 2 4 8 16",
+    )
+    parser.add_argument(
+        "--load-shape-phase-duration",
+        type=str,
+        default="3min",
+        help="Must be used with --load-shape. Duration of every phase including its warm-up, e.g. 180s or 3min. Defaults to 3min",
+    )
+    parser.add_argument(
+        "--load-shape-warmup",
+        type=str,
+        default="20s",
+        help="Must be used with --load-shape. Time at the start of every phase that is excluded from its stats. Defaults to 20s",
+    )
+    parser.add_argument(
+        "--load-shape-sine-amplitude",
+        type=float,
+        default=0.5,
+        help="Must be used with --load-shape sine. Amplitude of the oscillation relative to the level. Defaults to 0.5",
+    )
+    parser.add_argument(
+        "--load-shape-sine-period",
+        type=str,
+        default="60s",
+        help="Must be used with --load-shape sine. Period of the oscillation. Defaults to 60s",
+    )
+    parser.add_argument(
+        "--load-shape-output",
+        type=str,
+        default=None,
+        help="Must be used with --load-shape. Prefix of the directories to write the stats of every phase to, the level and 'u' or 'qps' are appended. E.g. 'results/qwen3-8b_in3000_out140_' gives the layout read by extract_latency_stats.py",
+    )
+    parser.add_argument(
+        "--trace",
+        type=str,
+        default=None,
+        help="Replay arrivals and request lengths from a production trace (CSV or JSONL with 'timestamp', 'input_tokens', 'output_tokens' and optional 'model' and 'priority' fields). Requests are issued at their recorded times regardless of the number of users and outstanding requests, --prompt-tokens and --max-tokens are ignored. The test stops at the end of the trace",
+    )
+    parser.add_argument(
+        "--trace-speedup",
+        type=float,
+        default=1.0,
+        help="Must be used with --trace. Replays the trace this many times faster than recorded. Defaults to 1.0",
+    )
     parser.add_argument(
         "--burst",
         type=float,
         default=None,
         help="Makes requests to arrive in bursts every specified number of seconds. Note that burst duration has to be longer than maximum time of the response. Size of the burst is controlled by --users. The spawn rate -r is best set to a high value",
     )
+    parser.add_argument(
+        "--itl-stall-threshold",
+        type=float,
+        default=200,
+        help="With --stream, gaps between tokens longer than this many milliseconds are counted as stalls in the 'itl_stall' metric. Defaults to 200",
+    )
     parser.add_argument(
         "--show-response",
         action=argparse.BooleanOptionalAction,
@@ -1180,6 +3891,98 @@ def init_parser(parser):
         default=0,
         help="Maximum length of the prompt cache to use. Defaults to 0 (no caching).",
     )
+    parser.add_argument(
+        "--shared-prefix-count",
+        env_var="SHARED_PREFIX_COUNT",
+        type=int,
+        default=0,
+        help="Start prompts with one of the specified number of shared prefixes to measure prompt caching under a mix of tenants. Only applies to the 'limerics' dataset and replaces the common prefix of --prompt-cache-max-len (which is still sent to Fireworks). Defaults to 0 (disabled)",
+    )
+    parser.add_argument(
+        "--shared-prefix-tokens",
+        env_var="SHARED_PREFIX_TOKENS",
+        type=int,
+        default=0,
+        help="Must be used with --shared-prefix-count. Length of every shared prefix in tokens",
+    )
+    parser.add_argument(
+        "--shared-prefix-distribution",
+        type=str,
+        choices=["uniform", "zipf"],
+        default="uniform",
+        help="Must be used with --shared-prefix-count. How to pick the shared prefix for a request",
+    )
+    parser.add_argument(
+        "--shared-prefix-zipf-alpha",
+        type=float,
+        default=1.0,
+        help="Exponent of the 'zipf' --shared-prefix-distribution, higher values concentrate requests on fewer prefixes. Defaults to 1.0",
+    )
+    parser.add_argument(
+        "--shared-prefix-hit-ratio",
+        type=float,
+        default=1.0,
+        help="Must be used with --shared-prefix-count. Fraction of requests that reuse a shared prefix, the rest get a unique prefix that can't be cached. Defaults to 1.0",
+    )
+    parser.add_argument(
+        "--conversation-turns",
+        type=int,
+        nargs="+",
+        default=None,
+        metavar=("MIN", "MAX"),
+        help="Enables multi-turn conversations: every user keeps a chat session, sending the growing history with the model's actual replies and a new user turn on every request. The number of turns per conversation is sampled uniformly from [MIN, MAX] (or fixed if only MIN is given). Only supported with --chat",
+    )
+    parser.add_argument(
+        "--conversation-think-time",
+        type=float,
+        nargs="+",
+        default=None,
+        metavar=("MIN", "MAX"),
+        help="Must be used with --conversation-turns. Seconds to wait between turns of a conversation, sampled uniformly from [MIN, MAX]. Not compatible with --qps and --burst",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="Number of local worker processes to generate load with, -1 for one per CPU core. Runs Locust in distributed mode on this host: the master merges the stats of the workers into a single report",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["locust", "asyncio"],
+        default="locust",
+        help="How users are simulated. 'locust' runs every user as a separate Locust user. 'asyncio' runs all users as asyncio tasks of a single Locust user sharing an aiohttp session, which has much lower per-stream overhead and scales to tens of thousands of concurrent streams from one process. Not compatible with --trace and --conversation-turns",
+    )
+    parser.add_argument(
+        "--ttft-deadline",
+        type=float,
+        default=None,
+        help="Abandon requests that didn't produce the first token within this many seconds (mean of --deadline-distribution), closing the connection like a user giving up. Abandoned requests are reported in the 'abandoned_before_first_token' metric instead of the latency metrics",
+    )
+    parser.add_argument(
+        "--total-deadline",
+        type=float,
+        default=None,
+        help="Abandon requests that didn't complete within this many seconds (mean of --deadline-distribution), closing the connection mid-stream. Reported in the 'abandoned_before_first_token' or 'abandoned_during_generation' metric",
+    )
+    parser.add_argument(
+        "--deadline-distribution",
+        type=str,
+        choices=["constant", "uniform", "exponential"],
+        default="constant",
+        help="Must be used with --ttft-deadline or --total-deadline. How the patience of users is distributed around the deadline, sampled for every request. Defaults to constant",
+    )
+    parser.add_argument(
+        "--keep-alive",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Reuse connections between requests. With --no-keep-alive every request opens a new connection, which includes the DNS lookup and the TCP and TLS handshakes in its latency",
+    )
+    parser.add_argument(
+        "--connection-pool-size",
+        type=int,
+        default=None,
+        help="Maximum number of idle connections kept open by every user. Defaults to 10, or to --max-in-flight with --open-loop and --trace where one user sends many requests at once. With --engine asyncio it's the limit of open connections per process (unlimited by default)",
+    )
     parser.add_argument(
         "--header",
         action="append",
@@ -1202,21 +4005,92 @@ def init_parser(parser):
     )
 
 
-@events.quitting.add_listener
+def exit_on_init_error(message):
+    # exceptions in init listeners are only logged by Locust
+    print(message)
+    sys.exit(1)
+
+
+@events.init.add_listener
 def _(environment, **kw):
-    total_latency = environment.stats.entries[("total_latency", "METRIC")]
-    if environment.stats.total.num_failures > 0 or total_latency.num_requests == 0:
-        print("Test failed due to failed requests")
-        environment.process_exit_code = 1
-        return
+    options = environment.parsed_options
+    if options.processes != 1 and isinstance(environment.runner, LocalRunner):
+        # replaces this process with a master and workers, no users are spawned here
+        try:
+            exit_code = run_processes(options)
+        except Exception as e:
+            print(f"Failed to run worker processes: {repr(e)}")
+            print(traceback.format_exc())
+            exit_code = 1
+        sys.exit(exit_code)
+    if options.engine == "asyncio":
+        # Locust removes the directory of the locustfile from sys.path once it's imported
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        from async_engine import AsyncLLMUser
+
+        environment.user_classes = [AsyncLLMUser]
+        if isinstance(environment.runner, WorkerRunner):
+            # the number of users comes from the master with the rest of the options
+            return
+        # a single Locust user per process drives all the users, it reports spawning of the users by itself.
+        # Unlike -u and -r, custom options are passed to workers
+        options.asyncio_users = options.num_users or 1
+        options.asyncio_spawn_rate = options.spawn_rate or 1
+        if isinstance(environment.runner, MasterRunner):
+            options.num_users = options.expect_workers
+        else:
+            options.num_users = 1
+        events.spawning_complete.remove_listener(InitTracker.notify_spawning_complete)
+    if options.validate_output and (options.tokenizer is None or options.embeddings):
+        exit_on_init_error("--validate-output requires --tokenizer and a text output")
+    for name, values, minimum in [
+        ("--conversation-turns", options.conversation_turns, 1),
+        ("--conversation-think-time", options.conversation_think_time, 0),
+    ]:
+        if values is None:
+            continue
+        if len(values) > 2:
+            exit_on_init_error(f"{name} takes MIN and optionally MAX, got {len(values)} values")
+        if values[0] < minimum or values[0] > values[-1]:
+            exit_on_init_error(f"{name} requires {minimum} <= MIN <= MAX, got {values}")
+    if options.timeseries_file and not isinstance(environment.runner, WorkerRunner):
+        try:
+            import pyarrow.parquet  # noqa: F401
+        except ImportError:
+            exit_on_init_error("--timeseries-file requires pyarrow: pip install pyarrow")
+    if options.request_log and not isinstance(environment.runner, MasterRunner):
+        try:
+            import pyarrow.parquet  # noqa: F401
+        except ImportError:
+            exit_on_init_error("--request-log requires pyarrow: pip install pyarrow")
+    if options.load_shape and not isinstance(environment.runner, WorkerRunner):
+        if options.trace:
+            exit_on_init_error("--load-shape can't be combined with --trace")
+        if options.engine == "asyncio" and options.qps is None:
+            # asyncio users are spawned once by the engine
+            exit_on_init_error("--load-shape with --engine asyncio requires --qps")
+        try:
+            shape = PhasedLoadShape(environment)
+        except ValueError as e:
+            exit_on_init_error(str(e))
+        if options.qps is not None:
+            # the first phase starts at its own rate
+            options.qps = options.load_shape_levels[0]
+        shape.runner = environment.runner
+        environment.shape_class = shape
+
+
+def summary_entries(environment, concurrency):
+    """
+    Returns the summary of the stats collected so far, or None if there are failed requests or
+    no requests at all.
+    """
+    total_latency = METRICS.get("total_latency")
+    if environment.stats.total.num_failures > 0 or total_latency.count == 0:
+        return None
 
     entries = copy.copy(InitTracker.logging_params)
-    if environment.parsed_options.qps is not None:
-        entries["concurrency"] = (
-            f"QPS {environment.parsed_options.qps} {environment.parsed_options.qps_distribution}"
-        )
-    else:
-        entries["concurrency"] = InitTracker.users
+    entries["concurrency"] = concurrency
     for metric_name in [
         "time_to_first_token",
         "latency_per_token",
@@ -1224,38 +4098,148 @@ def _(environment, **kw):
         "total_latency",
         "prompt_tokens",  # might overwrite the static value based on server side tokenization
     ]:
-        entries[metric_name] = environment.stats.entries[
-            (metric_name, "METRIC")
-        ].avg_response_time
+        entries[metric_name] = METRICS.get(metric_name).mean
+    if environment.parsed_options.shared_prefix_count:
+        for metric_name in [
+            "time_to_first_token_prefix_hit",
+            "time_to_first_token_prefix_miss",
+        ]:
+            entries[metric_name] = METRICS.get(metric_name).mean
     if not environment.parsed_options.stream:
         # if there's no streaming these metrics are meaningless
         entries["time_to_first_token"] = ""
         entries["latency_per_token"] = ""
-    entries["num_requests"] = total_latency.num_requests
-    entries["qps"] = total_latency.total_rps
+    if environment.parsed_options.stream:
+        inter_token_latency = METRICS.get("inter_token_latency")
+        entries["p50_inter_token_latency"] = inter_token_latency.percentile(0.5)
+        entries["p99_inter_token_latency"] = inter_token_latency.percentile(0.99)
+        entries["max_inter_token_latency"] = inter_token_latency.max
+        entries["inter_token_stalls"] = METRICS.get("itl_stall").count
+    entries["num_requests"] = total_latency.count
+    if environment.parsed_options.validate_output:
+        entries["tokenizer_mismatches"] = METRICS.get("tokenizer_mismatch").count
+        entries["max_tokens_mismatches"] = METRICS.get("max_tokens_mismatch").count
+    entries["qps"] = METRICS.rate("total_latency")
+    if (
+        environment.parsed_options.ttft_deadline is not None
+        or environment.parsed_options.total_deadline is not None
+    ):
+        for metric_name in [
+            "abandoned_before_first_token",
+            "abandoned_during_generation",
+        ]:
+            entries[metric_name] = METRICS.get(metric_name).count
+    if environment.parsed_options.qps is not None or environment.parsed_options.trace:
+        # arrivals issued behind schedule or not at all make the offered load lower than intended
+        entries["late_arrivals"] = METRICS.get("arrival_lateness").count_above(
+            LATE_ARRIVAL_THRESHOLD_MS
+        )
+        entries["dropped_arrivals"] = METRICS.get("dropped_arrivals").count
     percentile_to_report = [50, 90, 95, 99, 99.9]
     percentile_metrics = ["time_to_first_token", "total_latency"]
     for percentile_metric in percentile_metrics:
-        metrics = environment.stats.entries[percentile_metric, "METRIC"]
+        metrics = METRICS.get(percentile_metric)
         for percentile in percentile_to_report:
             name = f"P{percentile}_{percentile_metric}"
-            entries[name] = metrics.get_response_time_percentile(percentile / 100)
+            entries[name] = metrics.percentile(percentile / 100)
+    # latency measured by an overloaded client includes its own queueing
+    saturation_reasons = ClientMonitor.saturation_reasons(METRICS)
+    if saturation_reasons:
+        print(
+            f"WARNING: the load generator was saturated, latencies are inflated by the client: {', '.join(saturation_reasons)}"
+        )
+    entries["client_saturated"] = ", ".join(saturation_reasons) or "no"
 
     pretty_name = lambda s: " ".join([w.capitalize() for w in s.split("_")])
-    entries = {pretty_name(k): v for k, v in entries.items()}
+    return {pretty_name(k): v for k, v in entries.items()}
+
+
+def write_summary_file(path, entries):
+    """
+    Appends the summary to the CSV file. The columns depend on the options of the run, if the
+    header of the file lacks some of them the file is rewritten with all columns, so rows of runs
+    with different options stay aligned.
+    """
+    header, rows = [], []
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        with open(path, newline="") as f:
+            reader = csv.DictReader(f)
+            header = reader.fieldnames or []
+            if set(entries) <= set(header):
+                # columns the run doesn't have are left empty
+                rows = None
+            else:
+                rows = list(reader)
+    if rows is None:
+        with open(path, "a", newline="") as f:
+            csv.DictWriter(f, fieldnames=header, restval="").writerow(entries)
+        return
+    fieldnames = header + [name for name in entries if name not in header]
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, restval="")
+        writer.writeheader()
+        writer.writerows(rows)
+        writer.writerow(entries)
+    os.replace(tmp_path, path)
+
+
+def print_metrics():
+    """Prints the metrics like Locust prints the response time percentiles of requests."""
+    percentiles = [0.5, 0.9, 0.99, 0.999]
+    name_width = max([len(name) for name in METRICS.histograms] + [len("Name")])
+    header = "".join(f"{f'{q * 100:g}%':>11}" for q in percentiles)
+    print("Metrics (HDR histograms)")
+    print(f"{'Name':<{name_width}} {'# samples':>10}{'Avg':>11}{'Min':>11}{'Max':>11}{header}")
+    print("-" * (name_width + 11 + 11 * (3 + len(percentiles))))
+    for name in sorted(METRICS.histograms):
+        histogram = METRICS.histograms[name]
+        values = [histogram.mean, histogram.min, histogram.max] + [
+            histogram.percentile(q) for q in percentiles
+        ]
+        print(f"{name:<{name_width}} {histogram.count:>10}" + "".join(f"{v:>11.3f}" for v in values))
+    print()
+
+
+@events.quitting.add_listener
+def _(environment, **kw):
+    if isinstance(environment.runner, WorkerRunner):
+        # workers send their stats to the master which writes the summary
+        return
+    # Locust prints its stats after this event, ours follow them
+    events.quit.add_listener(lambda **kw: print_metrics())
+    options = environment.parsed_options
+    if isinstance(environment.shape_class, PhasedLoadShape):
+        # earlier phases were summarized when they ended
+        environment.shape_class.finish_phase()
+        summaries = environment.shape_class.summaries
+        if environment.shape_class.failed or not summaries:
+            print("Test failed due to failed requests")
+            environment.process_exit_code = 1
+            if not summaries:
+                return
+    else:
+        if options.trace:
+            concurrency = f"Trace {options.trace} x{options.trace_speedup}"
+        elif options.qps is not None:
+            concurrency = f"QPS {options.qps} {options.qps_distribution}"
+        else:
+            concurrency = InitTracker.users
+        entries = summary_entries(environment, concurrency)
+        if entries is None:
+            print("Test failed due to failed requests")
+            environment.process_exit_code = 1
+            return
+        summaries = [entries]
+        if options.summary_file:
+            write_summary_file(options.summary_file, entries)
 
     # print in the final event handler to make sure our output is the last one
     @events.quit.add_listener
     def exit_printer(**kw):
-        max_width = max(len(k) for k in entries.keys())
-        print(" Summary ".center(80, "="))
-        for k, v in entries.items():
-            print(f"{k:<{max_width}}: {v}")
-        print("=" * 80)
-
-    if environment.parsed_options.summary_file:
-        with open(environment.parsed_options.summary_file, "a") as f:
-            writer = csv.DictWriter(f, fieldnames=entries.keys())
-            if f.tell() == 0:
-                writer.writeheader()
-            writer.writerow(entries)
\ No newline at end of file
+        for entries in summaries:
+            max_width = max(len(k) for k in entries.keys())
+            print(" Summary ".center(80, "="))
+            for k, v in entries.items():
+                print(f"{k:<{max_width}}: {v}")
+            print("=" * 80)
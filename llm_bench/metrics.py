@@ -0,0 +1,206 @@
+"""
+High-dynamic-range histograms for the metrics of load_test.py.
+
+Every metric (time to first token, tokens per request, client CPU usage, ...) is recorded into a
+histogram with log-linear buckets, like HdrHistogram: 2048 buckets per power of two keep 3
+significant digits at any magnitude, e.g. latencies in ms are exact to the microsecond below 2 ms
+and within 0.1% above. Recording a value is an index computation and an increment, percentiles
+are read from the cumulative counts, and histograms of different processes merge by adding them.
+"""
+import math
+import time
+
+import numpy as np
+
+# values are recorded as integers in units of 1/SCALE, microseconds for latencies in ms
+SCALE = 1000
+SUB_BUCKET_BITS = 11
+HALF_BUCKET_BITS = SUB_BUCKET_BITS - 1
+
+
+def bucket_index(units):
+    """Index of the bucket of a non-negative integer value."""
+    shift = units.bit_length() - SUB_BUCKET_BITS
+    if shift <= 0:
+        return units
+    return (shift << HALF_BUCKET_BITS) + (units >> shift)
+
+
+def bucket_indices(units):
+    """Vectorized `bucket_index` for an array of non-negative int64 values."""
+    bit_lengths = np.frexp(units.astype(np.float64))[1]
+    shifts = np.maximum(bit_lengths - SUB_BUCKET_BITS, 0).astype(np.int64)
+    return (shifts << HALF_BUCKET_BITS) + (units >> shifts)
+
+
+def bucket_highest_value(index):
+    """Highest value, in units, that falls into the bucket."""
+    shift = max(0, (index >> HALF_BUCKET_BITS) - 1)
+    lowest = (index - (shift << HALF_BUCKET_BITS)) << shift
+    return lowest + (1 << shift) - 1
+
+
+class HdrHistogram:
+    """Distribution of a single metric, values are floats with a precision of 1/SCALE."""
+
+    def __init__(self):
+        self.counts = np.zeros(2 << HALF_BUCKET_BITS, dtype=np.int64)
+        self.count = 0
+        self.sum = 0.0
+        self.length_sum = 0
+        # the extremes are tracked exactly
+        self._min = math.inf
+        self._max = -math.inf
+        self.last_time = None
+
+    def record(self, value, length=0):
+        units = max(0, int(value * SCALE + 0.5))
+        index = bucket_index(units)
+        if index >= len(self.counts):
+            self._grow(index)
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        self.length_sum += length
+        self._min = min(self._min, value)
+        self._max = max(self._max, value)
+        self.last_time = time.time()
+
+    def record_many(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if not len(values):
+            return
+        # rounds half up like `record`
+        units = np.maximum(np.floor(values * SCALE + 0.5), 0).astype(np.int64)
+        indices = bucket_indices(units)
+        max_index = int(indices.max())
+        if max_index >= len(self.counts):
+            self._grow(max_index)
+        self.counts += np.bincount(indices, minlength=len(self.counts))
+        self.count += len(values)
+        self.sum += float(values.sum())
+        self._min = min(self._min, float(values.min()))
+        self._max = max(self._max, float(values.max()))
+        self.last_time = time.time()
+
+    def _grow(self, index):
+        counts = np.zeros(max(index + 1, 2 * len(self.counts)), dtype=np.int64)
+        counts[: len(self.counts)] = self.counts
+        self.counts = counts
+
+    @property
+    def min(self):
+        return self._min if self.count else 0.0
+
+    @property
+    def max(self):
+        return self._max if self.count else 0.0
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    @property
+    def avg_length(self):
+        return self.length_sum / self.count if self.count else 0.0
+
+    def percentile(self, q):
+        """Value below which the fraction `q` of samples falls, within the bucket precision."""
+        if not self.count:
+            return 0.0
+        rank = max(1, math.ceil(q * self.count))
+        index = int(np.searchsorted(np.cumsum(self.counts), rank))
+        value = bucket_highest_value(index) / SCALE
+        return min(max(value, self._min), self._max)
+
+    def count_above(self, value):
+        """Number of samples in buckets above the one of `value`."""
+        index = bucket_index(max(0, int(value * SCALE + 0.5)))
+        return int(self.counts[index + 1 :].sum())
+
+    def merge(self, other):
+        if len(other.counts) > len(self.counts):
+            self._grow(len(other.counts) - 1)
+        self.counts[: len(other.counts)] += other.counts
+        self.count += other.count
+        self.sum += other.sum
+        self.length_sum += other.length_sum
+        self._min = min(self._min, other._min)
+        self._max = max(self._max, other._max)
+        if other.last_time is not None:
+            self.last_time = max(self.last_time or 0, other.last_time)
+
+    def serialize(self):
+        # sparse, most of the buckets are empty
+        indices = np.flatnonzero(self.counts)
+        return {
+            "indices": indices.tolist(),
+            "counts": self.counts[indices].tolist(),
+            "sum": self.sum,
+            "length_sum": self.length_sum,
+            "min": self._min,
+            "max": self._max,
+            "last_time": self.last_time,
+        }
+
+    @classmethod
+    def unserialize(cls, data):
+        histogram = cls()
+        if data["indices"]:
+            histogram._grow(max(data["indices"]))
+            histogram.counts[data["indices"]] = data["counts"]
+        histogram.count = int(sum(data["counts"]))
+        histogram.sum = data["sum"]
+        histogram.length_sum = data["length_sum"]
+        histogram._min = data["min"]
+        histogram._max = data["max"]
+        histogram.last_time = data["last_time"]
+        return histogram
+
+
+class MetricsRegistry:
+    """Histograms of all metrics of a process since the last reset."""
+
+    def __init__(self):
+        self.histograms = {}
+        self.start_time = time.time()
+
+    def record(self, name, value, length=0):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = HdrHistogram()
+        histogram.record(value, length)
+
+    def record_many(self, name, values):
+        if not len(values):
+            return
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = HdrHistogram()
+        histogram.record_many(values)
+
+    def get(self, name):
+        """Returns the histogram of the metric, empty if nothing was recorded."""
+        return self.histograms.get(name) or HdrHistogram()
+
+    def rate(self, name):
+        """Samples per second since the last reset, like Locust's `total_rps`."""
+        histogram = self.get(name)
+        if not histogram.count:
+            return 0.0
+        return histogram.count / max(histogram.last_time - self.start_time, 1e-3)
+
+    def reset(self, **kw):
+        self.histograms = {}
+        self.start_time = time.time()
+
+    def serialize(self):
+        return {name: h.serialize() for name, h in self.histograms.items() if h.count}
+
+    def merge_serialized(self, data):
+        for name, histogram_data in data.items():
+            histogram = HdrHistogram.unserialize(histogram_data)
+            if name in self.histograms:
+                self.histograms[name].merge(histogram)
+            else:
+                self.histograms[name] = histogram
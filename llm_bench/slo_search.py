@@ -0,0 +1,261 @@
+"""
+Find the maximum QPS or concurrency a deployment sustains within latency SLOs.
+
+Runs load_test.py at adaptively chosen levels: the level doubles until an SLO is violated, then
+the interval between the last passing and the first failing level is bisected. Arguments after
+`--` are passed to every run, e.g.:
+
+    python slo_search.py --qps-range 1 64 --slo 'time_to_first_token:p99<500' --slo 'latency_per_token:p50<30' \\
+        -- -H https://api.fireworks.ai/inference --api-key $FIREWORKS_API_KEY -m <model> -p 3000 -o 140 --stream -u 100
+
+Prints the frontier point and writes the metrics of every probe (the evidence) to
+`<output-dir>/probes.csv`; the stats of every run are kept in `<output-dir>/<level>qps` or
+`<output-dir>/<level>u`.
+"""
+import argparse
+import csv
+import os
+import re
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+SLO_RE = re.compile(r"^(\w+):(avg|p[\d.]+)<([\d.]+)$")
+# columns of stats_stats.csv other than the percentiles
+STAT_COLUMNS = {"avg": "Average Response Time", "rps": "Requests/s"}
+
+
+def parse_slo(slo_str):
+    match = SLO_RE.match(slo_str)
+    if match is None:
+        raise argparse.ArgumentTypeError(
+            f"Invalid SLO '{slo_str}', expected METRIC:STAT<LIMIT, e.g. time_to_first_token:p99<500"
+        )
+    metric, stat, limit = match.groups()
+    return metric, stat, float(limit)
+
+
+def stat_column(stat):
+    return STAT_COLUMNS.get(stat) or f"{stat[1:]}%"
+
+
+def read_csv_rows(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, newline="") as f:
+        return list(csv.DictReader(f))
+
+
+class Probe:
+    """Result of a single run at one level."""
+
+    def __init__(self, level, results_dir, exit_code):
+        self.level = level
+        self.results_dir = results_dir
+        self.exit_code = exit_code
+        self.stats = {
+            row["Name"]: row
+            for row in read_csv_rows(os.path.join(results_dir, "stats_stats.csv"))
+            if row["Type"] == "METRIC"
+        }
+        summaries = read_csv_rows(os.path.join(results_dir, "summary.csv"))
+        self.summary = summaries[-1] if summaries else {}
+        self.violations = []
+
+    def value(self, metric, stat):
+        row = self.stats.get(metric)
+        if row is None or row[stat_column(stat)] in ("", "N/A"):
+            return None
+        return float(row[stat_column(stat)])
+
+    @property
+    def throughput(self):
+        return self.value("total_latency", "rps") or 0.0
+
+    @property
+    def output_tokens_per_second(self):
+        num_tokens = self.value("num_tokens", "avg") or 0.0
+        return self.throughput * num_tokens
+
+    def check(self, slos, qps_mode, min_qps_ratio):
+        """Fills `violations` with the reasons the level isn't sustainable."""
+        if self.exit_code != 0:
+            self.violations.append(f"load test failed with exit code {self.exit_code}")
+        if not self.stats:
+            self.violations.append("no stats")
+            return
+        for metric, stat, limit in slos:
+            value = self.value(metric, stat)
+            if value is None:
+                self.violations.append(f"{metric}:{stat} missing")
+            elif value >= limit:
+                self.violations.append(f"{metric}:{stat} {value:g} >= {limit:g}")
+        if qps_mode and self.throughput < min_qps_ratio * self.level:
+            self.violations.append(
+                f"throughput {self.throughput:.2f} below {min_qps_ratio:g} of target QPS"
+            )
+        if int(self.summary.get("Dropped Arrivals") or 0) > 0:
+            self.violations.append(f"{self.summary['Dropped Arrivals']} dropped arrivals")
+        if self.summary.get("Client Saturated", "no") != "no":
+            # the latencies can't be trusted, a more powerful client is needed
+            self.violations.append(f"client saturated: {self.summary['Client Saturated']}")
+
+    @property
+    def passed(self):
+        return not self.violations
+
+
+def run_probe(args, level, qps_mode, locust_args):
+    label = f"{level:g}qps" if qps_mode else f"{level}u"
+    results_dir = os.path.join(args.output_dir, label)
+    os.makedirs(results_dir, exist_ok=True)
+    cmd = [
+        sys.executable,
+        "-m",
+        "locust",
+        "-f",
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "load_test.py"),
+        "--headless",
+        "--only-summary",
+        "-t",
+        args.duration,
+        "--csv",
+        os.path.join(results_dir, "stats"),
+        "--summary-file",
+        os.path.join(results_dir, "summary.csv"),
+    ]
+    if qps_mode:
+        cmd += ["--qps", f"{level:g}"]
+    else:
+        cmd += ["-u", str(level), "-r", str(args.spawn_rate)]
+    cmd += locust_args
+    print(f"\n=== Probing {label} ===")
+    print(f"Command: {' '.join(cmd)}")
+    exit_code = subprocess.run(cmd).returncode
+    probe = Probe(level, results_dir, exit_code)
+    probe.check(args.slo, qps_mode, args.min_qps_ratio)
+    print(f"=== {label}: {'PASS' if probe.passed else 'FAIL (' + '; '.join(probe.violations) + ')'} ===")
+    return probe
+
+
+def search(args, qps_mode, locust_args):
+    """
+    Doubles the level until a probe fails, then bisects between the last passing and the first
+    failing level. Returns all probes in the order they ran.
+    """
+    low, high = args.qps_range or args.concurrency_range
+    probes = []
+
+    def probe(level):
+        if probes:
+            time.sleep(args.cooldown)
+        probes.append(run_probe(args, level, qps_mode, locust_args))
+        return probes[-1].passed
+
+    if not probe(low):
+        return probes
+    passed, failed = low, None
+    while failed is None and passed < high and len(probes) < args.max_probes:
+        level = min(passed * 2, high)
+        if probe(level):
+            passed = level
+        else:
+            failed = level
+    while failed is not None and len(probes) < args.max_probes:
+        if qps_mode:
+            if failed - passed <= args.tolerance * passed:
+                break
+            level = (passed + failed) / 2
+        else:
+            if failed - passed <= max(1, args.tolerance * passed):
+                break
+            level = (passed + failed) // 2
+        if probe(level):
+            passed = level
+        else:
+            failed = level
+    return probes
+
+
+def main():
+    if "--" in sys.argv:
+        separator = sys.argv.index("--")
+        argv, locust_args = sys.argv[1:separator], sys.argv[separator + 1 :]
+    else:
+        argv, locust_args = sys.argv[1:], []
+
+    parser = argparse.ArgumentParser(
+        description="Search for the maximum load that meets latency SLOs. Arguments after '--' are passed to load_test.py"
+    )
+    levels = parser.add_mutually_exclusive_group(required=True)
+    levels.add_argument("--qps-range", nargs=2, type=float, metavar=("MIN", "MAX"),
+                        help="Search over QPS between MIN and MAX (pass -u to load_test.py, or --open-loop)")
+    levels.add_argument("--concurrency-range", nargs=2, type=int, metavar=("MIN", "MAX"),
+                        help="Search over concurrency between MIN and MAX")
+    parser.add_argument("--slo", action="append", type=parse_slo, required=True,
+                        help="Upper bound in ms on a metric of the stats CSV, e.g. time_to_first_token:p99<500 or latency_per_token:avg<30. STAT is avg or pNN. Can be used multiple times")
+    parser.add_argument("--duration", default="2min", help="Duration of every probe. Defaults to 2min")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="Stop bisecting when the gap between passing and failing levels is below this fraction. Defaults to 0.1")
+    parser.add_argument("--max-probes", type=int, default=12, help="Maximum number of runs. Defaults to 12")
+    parser.add_argument("--min-qps-ratio", type=float, default=0.95,
+                        help="In QPS mode, a level fails if the achieved throughput is below this fraction of it. Defaults to 0.95")
+    parser.add_argument("--spawn-rate", type=int, default=100, help="Rate of spawning users in concurrency mode")
+    parser.add_argument("--cooldown", type=float, default=10, help="Seconds to wait between probes. Defaults to 10")
+    parser.add_argument("--output-dir", default=None,
+                        help="Directory for the results of every probe. Defaults to results/slo_search_<timestamp>")
+    args = parser.parse_args(argv)
+
+    qps_mode = args.qps_range is not None
+    low, high = args.qps_range or args.concurrency_range
+    if not 0 < low <= high:
+        parser.error("the range must satisfy 0 < MIN <= MAX")
+    if args.output_dir is None:
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        args.output_dir = os.path.join("results", f"slo_search_{timestamp}")
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    probes = search(args, qps_mode, locust_args)
+
+    unit = "QPS" if qps_mode else "Concurrency"
+    slo_names = [f"{metric}:{stat}" for metric, stat, _ in args.slo]
+    probes_path = os.path.join(args.output_dir, "probes.csv")
+    with open(probes_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow([unit, "Passed", "Requests/s", "Output Tokens/s"] + slo_names + ["Violations", "Results"])
+        for p in sorted(probes, key=lambda p: p.level):
+            writer.writerow(
+                [p.level, p.passed, p.throughput, p.output_tokens_per_second]
+                + [p.value(metric, stat) for metric, stat, _ in args.slo]
+                + ["; ".join(p.violations), p.results_dir]
+            )
+
+    passing = [p for p in probes if p.passed]
+    failing = [p for p in probes if not p.passed]
+    print(" SLO search ".center(80, "="))
+    print(f"SLOs: {', '.join(f'{metric}:{stat} < {limit:g} ms' for metric, stat, limit in args.slo)}")
+    for p in sorted(probes, key=lambda p: p.level):
+        status = "PASS" if p.passed else "FAIL"
+        print(f"  {unit} {p.level:<8g} {status}  {p.throughput:8.2f} req/s  {'; '.join(p.violations)}")
+    if passing:
+        best = max(passing, key=lambda p: p.level)
+        print(f"Max sustainable {unit}: {best.level:g}")
+        print(f"  Throughput: {best.throughput:.2f} req/s, {best.output_tokens_per_second:.1f} output tokens/s")
+        for (metric, stat, limit), name in zip(args.slo, slo_names):
+            print(f"  {name}: {best.value(metric, stat):g} ms (limit {limit:g})")
+        above = [p for p in failing if p.level > best.level]
+        if above:
+            first_failure = min(above, key=lambda p: p.level)
+            print(f"  Next level {first_failure.level:g} fails: {'; '.join(first_failure.violations)}")
+        elif best.level >= high:
+            print("  The top of the range passes, the frontier may be higher")
+    else:
+        print(f"No level meets the SLOs, {unit} {low:g} fails")
+    print(f"Evidence: {probes_path}")
+    print("=" * 80)
+    sys.exit(0 if passing else 1)
+
+
+if __name__ == "__main__":
+    main()
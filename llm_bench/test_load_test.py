@@ -0,0 +1,110 @@
+import time
+import types
+
+import gevent
+import pytest
+
+import load_test
+from load_test import FixedQPSPacer, InitTracker, SSEDecoder
+
+
+@pytest.fixture
+def environment(monkeypatch):
+    monkeypatch.setattr(
+        InitTracker,
+        "environment",
+        types.SimpleNamespace(
+            parsed_options=types.SimpleNamespace(qps=None, metrics_as_requests=False),
+            runner=None,
+        ),
+    )
+    monkeypatch.setattr(FixedQPSPacer, "_instance", None)
+    # arrival lateness is recorded on every arrival
+    monkeypatch.setattr(load_test, "METRICS", load_test.MetricsRegistry())
+
+
+def rate(arrivals, start, end):
+    return sum(start <= t < end for t in arrivals) / (end - start)
+
+
+@pytest.mark.parametrize("qps, new_qps", [(10, 40), (40, 10)])
+def test_set_qps_rate(environment, qps, new_qps):
+    """Users wait for arrivals and respond instantly, like LLMUser with --qps."""
+    pacer = FixedQPSPacer.instance(qps, "constant")
+    arrivals = []
+
+    def user():
+        while True:
+            pacer.wait()
+            arrivals.append(time.time())
+
+    # idle users hold arrivals scheduled seconds ahead
+    users = [gevent.spawn(user) for _ in range(100)]
+    gevent.sleep(2)
+    switch = time.time()
+    FixedQPSPacer.set_qps(new_qps)
+    gevent.sleep(2.5)
+    gevent.killall(users)
+
+    assert rate(arrivals, switch - 1.5, switch) == pytest.approx(qps, rel=0.1)
+    # the arrivals held at the switch don't add up with the new ones
+    assert rate(arrivals, switch + 0.1, switch + 2.1) == pytest.approx(new_qps, rel=0.1)
+
+
+def decode(chunks, flush=True):
+    decoder = SSEDecoder()
+    events = []
+    for chunk in chunks:
+        events.extend(bytes(event) for event in decoder.feed(chunk))
+    if flush:
+        events.extend(bytes(event) for event in decoder.flush())
+    return events
+
+
+STREAM = (
+    b": keep-alive comment\r\n"
+    b"event: message\r\n"
+    b"id: 1\r\n"
+    b'data: {"a": 1}\r\n'
+    b"\r\n"
+    b"data: first\n"
+    b"data:second\n"
+    b"data: \n"
+    b"retry: 100\n"
+    b"\n"
+    b": only a comment\n"
+    b"\n"
+    b"data: [DONE]\n"
+    b"\n"
+)
+STREAM_EVENTS = [b'{"a": 1}', b"first\nsecond\n", b"[DONE]"]
+
+
+def test_sse_decoder_events():
+    assert decode([STREAM]) == STREAM_EVENTS
+
+
+@pytest.mark.parametrize("split", range(1, len(STREAM)))
+def test_sse_decoder_split(split):
+    """Reads can end anywhere, including mid-line and between \\r and \\n."""
+    assert decode([STREAM[:split], STREAM[split:]]) == STREAM_EVENTS
+
+
+def test_sse_decoder_byte_by_byte():
+    assert decode([STREAM[i : i + 1] for i in range(len(STREAM))]) == STREAM_EVENTS
+
+
+def test_sse_decoder_pending_event():
+    decoder = SSEDecoder()
+    assert [bytes(e) for e in decoder.feed(b"data: a\n\ndata: b\r\n")] == [b"a"]
+    # the event isn't complete until the blank line
+    assert list(decoder.feed(b"data: c")) == []
+    assert [bytes(e) for e in decoder.flush()] == [b"b\nc"]
+    assert list(decoder.flush()) == []
+
+
+def test_sse_decoder_flush_without_blank_line():
+    assert decode([b"data: [DONE]"]) == [b"[DONE]"]
+    assert decode([b"data: x\r\n"]) == [b"x"]
+    assert decode([b": comment"]) == []
+    assert decode([b"data: x\n\n"], flush=False) == [b"x"]
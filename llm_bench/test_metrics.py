@@ -0,0 +1,120 @@
+import numpy as np
+import pytest
+
+from metrics import (
+    SCALE,
+    HdrHistogram,
+    bucket_highest_value,
+    bucket_index,
+    bucket_indices,
+)
+
+# 3 significant digits: exact to the unit at small values, within 0.1% above
+PRECISION = dict(rel=1e-3, abs=1 / SCALE)
+
+
+def boundary_values():
+    """Values around every power of two, where the bucket width doubles."""
+    values = set(range(5000))
+    for bits in range(12, 41):
+        for delta in (-2, -1, 0, 1, 2):
+            values.add((1 << bits) + delta)
+    return np.array(sorted(values), dtype=np.int64)
+
+
+def test_bucket_indices_match_bucket_index():
+    units = boundary_values()
+    rng = np.random.default_rng(0)
+    units = np.concatenate([units, rng.integers(0, 1 << 40, 10000)])
+    assert bucket_indices(units).tolist() == [bucket_index(int(u)) for u in units]
+
+
+def test_buckets_are_contiguous():
+    """Every bucket ends one unit before the next one starts."""
+    for units in boundary_values():
+        units = int(units)
+        index = bucket_index(units)
+        highest = bucket_highest_value(index)
+        assert units <= highest
+        assert bucket_index(highest) == index
+        assert bucket_index(highest + 1) == index + 1
+        # the bucket width is within the precision
+        assert highest - units <= max(0, units / 1000)
+
+
+@pytest.mark.parametrize(
+    "values",
+    [
+        np.random.default_rng(1).lognormal(3, 2, 20011),
+        np.random.default_rng(2).uniform(0, 2, 5003),
+        np.random.default_rng(3).exponential(500, 20011),
+        np.array([7.0]),
+    ],
+    ids=["lognormal", "below_2ms", "exponential", "single"],
+)
+def test_percentiles(values):
+    # the sizes keep q * len(values) away from integers, where rounding decides the rank
+    histogram = HdrHistogram()
+    histogram.record_many(values)
+    for q in [0.01, 0.1, 0.5, 0.9, 0.99, 0.999, 1.0]:
+        expected = np.percentile(values, q * 100, method="inverted_cdf")
+        assert histogram.percentile(q) == pytest.approx(expected, **PRECISION)
+    assert histogram.min == values.min()
+    assert histogram.max == values.max()
+    assert histogram.mean == pytest.approx(values.mean())
+
+
+def test_record_many_matches_record():
+    values = np.random.default_rng(4).lognormal(2, 3, 5000)
+    # rounding of values at half a unit
+    values = np.concatenate([values, [0.0, -1.0, 0.0005, 0.0015, 2.0475, 1e6]])
+    one_by_one = HdrHistogram()
+    for value in values:
+        one_by_one.record(value)
+    at_once = HdrHistogram()
+    at_once.record_many(values)
+    size = max(len(one_by_one.counts), len(at_once.counts))
+    assert np.array_equal(
+        np.pad(one_by_one.counts, (0, size - len(one_by_one.counts))),
+        np.pad(at_once.counts, (0, size - len(at_once.counts))),
+    )
+    assert at_once.count == one_by_one.count == len(values)
+    assert at_once.sum == pytest.approx(one_by_one.sum)
+    assert (at_once.min, at_once.max) == (one_by_one.min, one_by_one.max)
+
+
+def test_merge():
+    rng = np.random.default_rng(5)
+    small, large = rng.uniform(1, 10, 1000), rng.uniform(1e5, 1e7, 1000)
+    merged = HdrHistogram()
+    merged.record_many(small)
+    other = HdrHistogram()
+    # needs more buckets than the histogram it's merged into
+    other.record_many(large)
+    merged.merge(other)
+    merged.merge(HdrHistogram())
+
+    expected = HdrHistogram()
+    expected.record_many(np.concatenate([small, large]))
+    assert np.array_equal(merged.counts, expected.counts)
+    assert merged.count == 2000
+    assert merged.sum == pytest.approx(expected.sum)
+    assert (merged.min, merged.max) == (small.min(), large.max())
+    assert merged.percentile(0.5) == expected.percentile(0.5)
+
+
+def test_serialize_round_trip():
+    histogram = HdrHistogram()
+    for value, length in [(0.5, 3), (12.25, 5), (98765.4, 7)]:
+        histogram.record(value, length)
+    restored = HdrHistogram.unserialize(histogram.serialize())
+    assert np.array_equal(restored.counts[: len(histogram.counts)], histogram.counts)
+    assert restored.count == 3
+    assert (restored.sum, restored.length_sum) == (histogram.sum, histogram.length_sum)
+    assert (restored.min, restored.max) == (0.5, 98765.4)
+    assert restored.last_time == histogram.last_time
+    for q in [0.1, 0.5, 1.0]:
+        assert restored.percentile(q) == histogram.percentile(q)
+
+    empty = HdrHistogram.unserialize(HdrHistogram().serialize())
+    assert (empty.count, empty.min, empty.max, empty.percentile(0.5)) == (0, 0.0, 0.0, 0.0)